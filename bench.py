@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+import build
+import yaml
+import json
+import random
+import struct
+import zlib
+import platform
+import resource
+import multiprocessing
+import io
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter_ns
+from sys import exit
+
+default_sizes = [10, 100, 1000, 10000]
+default_object_counts = [10, 100, 1000]
+default_file_sizes    = [1024, 64*1024]
+build_src_path = Path(build.__file__).parent/"src"
+build_img_path = Path(build.__file__).parent/"img"
+
+## build scaling ###############################################################
+
+# Times the stages of build.py that scale with the catalog on synthetic
+# galleries. Every stage is run `repeat` times and the fastest run is kept.
+def bench_build(sizes:list[int]=default_sizes, repeat:int=3, seed:int=0) -> dict:
+    results = []
+    for n in sizes:
+        with TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            artists = max(1, n//10)
+            gen_catalog(tmp, n, artists, random.Random(seed))
+            yaml_file, img_path = tmp/'metadata.yaml', tmp/'img'
+
+            metas    = build.parse_metadata(yaml_file, img_path)
+            artworks = [build.load_image(meta) for meta in metas]
+            result = {
+                'artworks'       : n,
+                'artists'        : artists,
+                'parse_metadata' : best_of(repeat, lambda: build.parse_metadata(yaml_file, img_path)),
+                'thumb_sizes'    : best_of(repeat, lambda: [build.thumb_sizes(a.size) for a in artworks]),
+                'load_image'     : best_of(repeat, lambda: [build.load_image(meta) for meta in metas]),
+                'gen_html'       : best_of(repeat, lambda: build.gen_html(artworks, build_src_path, False)) }
+        print_result(result)
+        results.append(result)
+    return {
+        'benchmark' : 'build',
+        'commit'    : build.git_short_hash(),
+        'python'    : platform.python_version(),
+        'machine'   : platform.machine(),
+        'repeat'    : repeat,
+        'results'   : results }
+
+def best_of(repeat:int, fn) -> float:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        fn()
+        t = perf_counter_ns()-start
+        best = t if best is None else min(best, t)
+    return best/1000000000
+
+def print_result(result:dict):
+    stages = ' '.join(f'{k} {v*1000:>9.3f}ms' for k,v in result.items() if isinstance(v, float))
+    print(f"{result['artworks']:>6} artworks  {stages}")
+
+### synthetic catalogs #########################################################
+
+# a few source extents, roughly the shapes found in img/
+synthetic_extents = [(1200, 1200), (2000, 1500), (1500, 2000), (3000, 1800), (800, 1000), (4000, 3000)]
+
+def gen_catalog(path:Path, artworks:int, artists:int, rng:random.Random):
+    with open(build_src_path/"metadata.yaml", 'r') as file:
+        config = list(yaml.safe_load_all(file))[2]
+    kinds = list(config['link_templates'].keys())
+
+    yaml_artists = {}
+    for i in range(artists):
+        links = {}
+        for kind in rng.sample(kinds, rng.randint(1, 5)):
+            links[kind] = ' '.join(f'{kind}{i}' for _ in range(config['link_templates'][kind].count('$')))
+        yaml_artists[f'artist{i}'] = {'name': f'Artist Number {i}', 'links': links}
+
+    pngs = [png_bytes(w,h) for w,h in synthetic_extents]
+    yaml_artworks = {}
+    for i in range(artworks):
+        name = f'artist{rng.randrange(artists)}/art{i:05}.png'
+        file = path/'img'/name
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(rng.choice(pngs))
+        yaml_artworks[name] = {
+            'date': f'20{rng.randint(18,24)}-{rng.randint(1,12):02}-{rng.randint(1,28):02} 12:00+0000',
+            'alt':  f'Synthetic artwork number {i}',
+            'sha3': '%056x' % rng.getrandbits(224) }
+
+    # the first two artworks double as profile picture and refsheet
+    names = list(yaml_artworks.keys())
+    config = dict(config, pfp=names[0], refsheet=names[min(1, len(names)-1)])
+    with open(path/'metadata.yaml', 'w') as file:
+        yaml.safe_dump_all([yaml_artworks, yaml_artists, config], file, sort_keys=False)
+
+def png_bytes(w:int, h:int) -> bytes:
+    # a valid all black greyscale png, only its header is ever read
+    def chunk(kind:bytes, data:bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind+data))
+    rows = zlib.compress(bytes(h*(w+1)), 9)
+    return b'\x89PNG\r\n\x1a\n' + \
+           chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 0, 0, 0, 0)) + \
+           chunk(b'IDAT', rows) + \
+           chunk(b'IEND', b'')
+
+## image backends ##############################################################
+
+# Encodes the full thumbnail ladder of every original once per backend. Each
+# run gets a fresh process, so its peak RSS belongs to that artwork and
+# backend alone. idle_rss_mb is the process before the backend was imported.
+def bench_backends(backends:list[str]=list(build.image_backends), cascade:bool=True,
+                   src_path:Path=build_src_path, img_path:Path=build_img_path) -> dict:
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for meta in build.parse_metadata(src_path/'metadata.yaml', img_path):
+        art = build.load_image(meta)
+        for backend in backends:
+            with TemporaryDirectory() as tmp, ProcessPoolExecutor(1, mp_context=context) as pool:
+                outputs = [build.ThumbOutput(size, quality, Path(tmp)/f'{size}.{ext}')
+                           for size in art.thumbs for ext,quality in build.thumb_formats]
+                job = build.ThumbJob(meta.path, meta.sha3, outputs, cascade, backend)
+                try:
+                    measured = pool.submit(measure_thumb_job, job).result()
+                except Exception as e:
+                    # typically a backend whose library is not installed
+                    measured = {'error': f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"}
+            result = {
+                'artwork' : meta.slug,
+                'backend' : backend,
+                'pixels'  : art.size.w*art.size.h,
+                'outputs' : len(outputs),
+                **measured }
+            print_backend_result(result)
+            results.append(result)
+    return {
+        'benchmark' : 'backends',
+        'commit'    : build.git_short_hash(),
+        'python'    : platform.python_version(),
+        'machine'   : platform.machine(),
+        'cascade'   : cascade,
+        'results'   : results }
+
+def measure_thumb_job(job:build.ThumbJob) -> dict:
+    idle = peak_rss_mb()
+    start = perf_counter_ns()
+    build.run_thumb_outputs(job)
+    return {
+        'seconds'     : (perf_counter_ns()-start)/1000000000,
+        'peak_rss_mb' : peak_rss_mb(),
+        'idle_rss_mb' : idle,
+        'bytes'       : sum(out.entry.stat().st_size for out in job.outputs) }
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux but in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/(1024*1024 if platform.system() == 'Darwin' else 1024)
+
+def print_backend_result(result:dict):
+    if 'error' in result:
+        print(f"{result['artwork']:<40} {result['backend']:<8} {result['error']}")
+    else:
+        print(f"{result['artwork']:<40} {result['backend']:<8} {result['seconds']*1000:>9.1f}ms"
+              f" {result['peak_rss_mb']:>8.1f}MiB peak {result['bytes']/1024:>9.1f}KiB")
+
+## deploy #####################################################################
+
+# Times sync and push of deploy.py against an in-process FakeS3 on synthetic
+# www directories. Every combination of object count and file size runs five
+# scenarios in order: a first sync to an empty bucket, a sync with nothing to
+# do, a sync after a tenth of the files changed, a sync that has to delete
+# more stale keys than fit in one deleteObjects and a push of every file.
+# After each one the bucket and its manifest must match www exactly, so at
+# 1000 objects the paginated listing and the batched deletes are checked too.
+# Requests are counted by deploy.py itself, so they are the numbers a real
+# deploy would print. Files above deploy.multipart_threshold go up in parts.
+def bench_deploy(object_counts:list[int]=default_object_counts, file_sizes:list[int]=default_file_sizes,
+                 latency:float=0.02, workers:int|None=None, seed:int=0) -> dict:
+    import deploy
+    workers = deploy.default_workers if workers is None else workers
+    rng = random.Random(seed)
+    results = []
+    for n in object_counts:
+        for size in file_sizes:
+            with TemporaryDirectory() as tmp:
+                www_path = Path(tmp)
+                (www_path/'index.html').write_text('<!doctype html><title>bench</title>', encoding='utf-8')
+                names = [f'object{i:05}.bin' for i in range(n)]
+                for name in names:
+                    (www_path/name).write_bytes(rng.randbytes(size))
+                s3 = FakeS3(latency)
+
+                def run(scenario:str, fn):
+                    # a real deploy is a fresh process that hashes every file
+                    deploy.opcount.clear()
+                    deploy.hashes.clear()
+                    start = perf_counter_ns()
+                    with redirect_stdout(io.StringIO()):
+                        fn()
+                    result = {
+                        'objects'   : n,
+                        'file_size' : size,
+                        'scenario'  : scenario,
+                        'seconds'   : (perf_counter_ns()-start)/1000000000,
+                        'ops'       : {c:sum(v[i] for v in deploy.opcount.values()) for c,i in deploy.opclass_index.items()},
+                        'by_op'     : {k:list(v) for k,v in deploy.opcount.items()} }
+                    print_deploy_result(result)
+                    results.append(result)
+                    check_bucket(s3, www_path, scenario)
+
+                sync = lambda: deploy.sync(workers=workers, s3=s3, www_path=www_path)
+                run('sync empty', sync)
+                run('sync unchanged', sync)
+                for name in names[:max(1, n//10)]:
+                    (www_path/name).write_bytes(rng.randbytes(size))
+                run('sync changed', sync)
+                for i in range(deploy.delete_batch+n):
+                    s3.store(f'stale{i:05}.bin', b'', '"stale"', {}, {})
+                run('sync stale', sync)
+                run('push', lambda: deploy.push(names, workers=workers, s3=s3, www_path=www_path))
+    return {
+        'benchmark' : 'deploy',
+        'commit'    : build.git_short_hash(),
+        'python'    : platform.python_version(),
+        'machine'   : platform.machine(),
+        'latency'   : latency,
+        'workers'   : workers,
+        'results'   : results }
+
+def check_bucket(s3:'FakeS3', www_path:Path, scenario:str):
+    import deploy
+    local  = set(deploy.object_key(f) for f in deploy.deployed_files(www_path))
+    remote = set(s3.objects) - {deploy.manifest_key}
+    manifest = json.loads(s3.objects[deploy.manifest_key]['Body'])
+    if remote != local or manifest.keys() != local:
+        exit(f'FATAL: {scenario} left {len(remote-local)} stale and {len(local-remote)} missing objects, '
+             f'{len(manifest.keys() ^ local)} wrong manifest entries')
+
+def print_deploy_result(result:dict):
+    ops = ' '.join(f'{c} {n:>5}' for c,n in result['ops'].items())
+    print(f"{result['objects']:>6} objects {result['file_size']:>9} bytes  {result['scenario']:<15}"
+          f" {result['seconds']*1000:>9.1f}ms  {ops}")
+
+### fake s3 ####################################################################
+from hashlib import md5
+from threading import Lock
+from time import sleep
+
+class NoSuchKey(Exception): pass
+
+# Just enough of a boto3 S3 client for deploy.py, kept in memory. Every call
+# sleeps for `latency` seconds first, outside the lock, so concurrent
+# requests overlap the way they do against a remote bucket. ETags are
+# computed like S3 does for single and multipart uploads.
+class FakeS3:
+    def __init__(self, latency:float=0.0):
+        self.latency = latency
+        self.objects:dict[str,dict] = {}
+        self.uploads:dict[str,dict[int,bytes]] = {}
+        self.lock = Lock()
+
+    def request(self):
+        if self.latency > 0: sleep(self.latency)
+
+    def store(self, key:str, body:bytes, etag:str, metadata:dict, headers:dict):
+        with self.lock:
+            self.objects[key] = {'Body': body, 'ETag': etag, 'Metadata': dict(metadata), 'Headers': headers}
+
+    def list_objects_v2(self, Bucket:str, ContinuationToken:str|None=None, MaxKeys:int=1000) -> dict:
+        self.request()
+        with self.lock:
+            keys = sorted(k for k in self.objects if ContinuationToken is None or k > ContinuationToken)
+            page = [{'Key': k, 'Size': len(self.objects[k]['Body']), 'ETag': self.objects[k]['ETag']}
+                    for k in keys[:MaxKeys]]
+        response = {'Contents': page, 'IsTruncated': len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]['Key']
+        return response
+
+    def get_object(self, Bucket:str, Key:str) -> dict:
+        self.request()
+        with self.lock:
+            if Key not in self.objects: raise NoSuchKey(Key)
+            return {'Body': io.BytesIO(self.objects[Key]['Body']), 'ETag': self.objects[Key]['ETag']}
+
+    def head_object(self, Bucket:str, Key:str) -> dict:
+        self.request()
+        with self.lock:
+            if Key not in self.objects: raise NoSuchKey(Key)
+            o = self.objects[Key]
+            return {'ContentLength': len(o['Body']), 'ETag': o['ETag'], 'Metadata': dict(o['Metadata']), **o['Headers']}
+
+    def put_object(self, Bucket:str, Key:str, Body, Metadata:dict={}, **headers) -> dict:
+        self.request()
+        body = Body if isinstance(Body, bytes) else Body.read()
+        etag = f'"{md5(body).hexdigest()}"'
+        self.store(Key, body, etag, Metadata, headers)
+        return {'ETag': etag}
+
+    def delete_objects(self, Bucket:str, Delete:dict) -> dict:
+        self.request()
+        if len(Delete['Objects']) > 1000:
+            raise ValueError('deleteObjects accepts at most 1000 keys')
+        with self.lock:
+            for o in Delete['Objects']:
+                self.objects.pop(o['Key'], None)
+        return {}
+
+    def create_multipart_upload(self, Bucket:str, Key:str, Metadata:dict={}, **headers) -> dict:
+        self.request()
+        upload_id = f'{Key}/{len(self.uploads)}'
+        with self.lock:
+            self.uploads[upload_id] = {'Key': Key, 'Metadata': Metadata, 'Headers': headers, 'Parts': {}}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket:str, Key:str, UploadId:str, PartNumber:int, Body:bytes) -> dict:
+        self.request()
+        with self.lock:
+            self.uploads[UploadId]['Parts'][PartNumber] = Body
+        return {'ETag': f'"{md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket:str, Key:str, UploadId:str, MultipartUpload:dict) -> dict:
+        self.request()
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+        parts = [upload['Parts'][p['PartNumber']] for p in MultipartUpload['Parts']]
+        etag = f'"{md5(b"".join(md5(p).digest() for p in parts)).hexdigest()}-{len(parts)}"'
+        self.store(Key, b''.join(parts), etag, upload['Metadata'], upload['Headers'])
+        return {'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket:str, Key:str, UploadId:str) -> dict:
+        self.request()
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+### argument parsing ###########################################################
+from sys import argv
+
+def help_text(exe:str) -> str:
+    return \
+f'''usage:
+  {exe} build [flags..]
+    times parse_metadata, thumb_sizes, load_image and gen_html on synthetic
+    catalogs of increasing size
+  {exe} backends [flags..]
+    encodes the thumbnails of every original in img/ with each image backend
+    and reports wall time and peak RSS per artwork
+  {exe} deploy [flags..]
+    times sync and push of deploy.py against an in-process fake S3, reports
+    the requests they make by op class and checks the bucket after each
+flags:
+  --help, -h      prints help message and quits
+  --sizes N,..    build: catalog sizes in artworks, defaults to {','.join(map(str,default_sizes))}
+  --repeat N      build: runs per stage, the fastest is reported, defaults to 3
+  --backends A,.. backends: backends to compare, defaults to {','.join(build.image_backends)}
+  --no-cascade    backends: resamples every rung from the original
+  --objects N,..  deploy: objects per bucket, defaults to {','.join(map(str,default_object_counts))}
+  --bytes N,..    deploy: bytes per object, defaults to {','.join(map(str,default_file_sizes))}
+  --latency MS    deploy: latency of every request, defaults to 20
+  --workers N     deploy: concurrent requests, defaults to those of deploy.py
+  --out FILE      writes the results as JSON to FILE'''
+
+if __name__ == "__main__":
+    args = argv[1:]
+    sizes    = build.pop_value(args, '--sizes')
+    repeat   = build.pop_value(args, '--repeat')
+    out      = build.pop_value(args, '--out')
+    backends = build.pop_value(args, '--backends')
+    objects  = build.pop_value(args, '--objects')
+    file_sizes = build.pop_value(args, '--bytes')
+    latency  = build.pop_value(args, '--latency')
+    workers  = build.pop_value(args, '--workers')
+    cascade  = '--no-cascade' not in args
+    if not cascade: args.remove('--no-cascade')
+    if '-h' in args or '--help' in args or len(args) == 0:
+        print(help_text(argv[0]))
+    elif args not in (['build'], ['backends'], ['deploy']):
+        print(f"unrecognised arguments: {' '.join(args)}\n" + help_text(argv[0]))
+    elif sizes is not None and not all(s.isdigit() and int(s) > 0 for s in sizes.split(',')):
+        print("--sizes expects a comma separated list of positive numbers\n" + help_text(argv[0]))
+    elif repeat is not None and not (repeat.isdigit() and int(repeat) > 0):
+        print("--repeat expects a positive number\n" + help_text(argv[0]))
+    elif backends is not None and not all(b in build.image_backends for b in backends.split(',')):
+        print(f"--backends expects a comma separated list of {', '.join(build.image_backends)}\n" + help_text(argv[0]))
+    elif any(v is not None and not all(n.isdigit() and int(n) > 0 for n in v.split(',')) for v in (objects, file_sizes, workers)):
+        print("--objects, --bytes and --workers expect positive numbers\n" + help_text(argv[0]))
+    elif latency is not None and not latency.replace('.', '', 1).isdigit():
+        print("--latency expects a number of milliseconds\n" + help_text(argv[0]))
+    elif args == ['deploy']:
+        report = bench_deploy(
+            object_counts = default_object_counts if objects    is None else [int(n) for n in objects.split(',')],
+            file_sizes    = default_file_sizes    if file_sizes is None else [int(n) for n in file_sizes.split(',')],
+            latency       = 0.02 if latency is None else float(latency)/1000,
+            workers       = None if workers is None else int(workers))
+        if out is not None:
+            Path(out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    elif args == ['backends']:
+        report = bench_backends(
+            backends = list(build.image_backends) if backends is None else backends.split(','),
+            cascade  = cascade)
+        if out is not None:
+            Path(out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    else:
+        report = bench_build(
+            sizes  = default_sizes if sizes  is None else [int(s) for s in sizes.split(',')],
+            repeat = 3             if repeat is None else int(repeat))
+        if out is not None:
+            Path(out).write_text(json.dumps(report, indent=2), encoding="utf-8")
@@ -4,55 +4,109 @@ perf_epoch = perf_counter_ns()
 import yaml
 from pathlib import Path
 from shutil import copy,rmtree
-from wand.image import Image
+import os
+import struct
+import gzip
 from math import floor
 import subprocess
-from fontTools import subset
-from dataclasses import dataclass
+from html.parser import HTMLParser
+from hashlib import sha3_224, sha3_256, sha3_384, sha3_512
+import mmap
+from sys import exit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext, contextmanager
+from functools import cache, partial
+from threading import get_ident, Thread
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from time import sleep
+import json
+from dataclasses import dataclass, field
+from base64 import b64encode
 from enum import Enum, verify, UNIQUE, CONTINUOUS
 from typing import Iterator,Tuple
 import re
+from typing import Protocol
 
 def main(skip_images = False,
          pretty      = False,
+         jobs        = os.cpu_count() or 1,
+         cascade     = True,
+         trace       = None,
+         page_size   = None,
+         hashed      = False,
+         adaptive    = False,
+         target_bpp  = None,
+         backend     = 'wand',
          src_path    = Path(__file__).parent/"src",
          dst_path    = Path(__file__).parent/"www",
          img_path    = Path(__file__).parent/"img",
-         data_path   = Path(__file__).parent/"data"):
+         data_path   = Path(__file__).parent/"data",
+         cache_path  = Path(__file__).parent/"cache"):
 
-    if not skip_images:
-        rmtree(dst_path, ignore_errors=True)
-    dst_path.mkdir(parents=True, exist_ok=True)
+    global tracing
+    tracing = trace is not None
 
     perf_pre  = perf_counter_ns()
+    options = ThumbOptions(hashed, cascade, adaptive, target_bpp, backend)
 
-    subset_font(str(data_path/"Nunito.ttf"), str(dst_path/"nunito.woff2"))
+    with span('parse_metadata'):
+        metas = parse_metadata(src_path/'metadata.yaml', img_path)
+    with span('verify_originals'):
+        mismatches = verify_originals(metas, cache_path/"integrity.json", jobs)
+    if len(mismatches) != 0:
+        exit(f'FATAL: {len(mismatches)} originals do not match their sha3 in metadata.yaml\n' +
+             '\n'.join(f'{meta.path}: expected {meta.sha3}, got {digest}' for meta,digest in mismatches))
 
-    perf_font = perf_counter_ns()
+    if not skip_images:
+        rmtree(dst_path, ignore_errors=True)
+    dst_path.mkdir(parents=True, exist_ok=True)
+
+    artworks = [ load_image(meta, backend) for meta in metas ]
 
     if not skip_images:
         copy(data_path/"favicon32.png", dst_path)
-
-    artworks = [ load_image(meta, None if skip_images else dst_path)
-                 for meta in parse_metadata(src_path/'metadata.yaml', img_path) ]
+        cache = ThumbCache(cache_path/"thumbs")
+        with span('generate_images'):
+            generate_images(artworks, dst_path, cache, jobs, options)
+        print(f"evicted {cache.evict()} stale thumbnails")
+    else:
+        # reuse placeholders and ladders of an earlier build, but never encode
+        load_cached(artworks, ThumbCache(cache_path/"thumbs"), options)
 
     perf_imgs   = perf_counter_ns()
 
-    html = gen_html(artworks, src_path, pretty)
-    (dst_path/'index.html').write_text(html, encoding="utf-8")
+    with span('gen_html'):
+        html, chunks = gen_html(artworks, src_path, pretty, page_size, options)
+    with span('write_html'):
+        (dst_path/'index.html').write_text(html, encoding="utf-8")
+        write_chunks(dst_path, chunks)
+
+    perf_html = perf_counter_ns()
+
+    with span('visible_text'):
+        text = visible_text(html + ''.join(map(''.join, chunks)))
+    with span('subset_font'):
+        subset_font(data_path/"Nunito.ttf", dst_path/"nunito.woff2", text, cache_path/"fonts")
+    with span('precompress'):
+        precompress(dst_path, jobs)
 
     perf_done = perf_counter_ns()
 
     t_total = float(perf_done-perf_epoch)/1000000000
     t_pream = float(perf_pre -perf_epoch)/1000000000
-    t_font  = float(perf_font-perf_pre  )/1000000000
-    t_imgs  = float(perf_imgs-perf_font )/1000000000
-    t_html  = float(perf_done-perf_imgs )/1000000000
+    t_imgs  = float(perf_imgs-perf_pre  )/1000000000
+    t_html  = float(perf_html-perf_imgs )/1000000000
+    t_font  = float(perf_done-perf_html )/1000000000
     print(f"TOTAL:    {t_total:>8.3f}s")
     print(f"preamble: {t_pream:>8.3f}s {100*t_pream/t_total:>3.0f}% " + progress_bar(t_pream/t_total, 10))
-    print(f"font:     {t_font :>8.3f}s {100*t_font /t_total:>3.0f}% " + progress_bar(t_font /t_total, 10))
     print(f"images:   {t_imgs :>8.3f}s {100*t_imgs /t_total:>3.0f}% " + progress_bar(t_imgs /t_total, 10))
     print(f"html:     {t_html :>8.3f}s {100*t_html /t_total:>3.0f}% " + progress_bar(t_html /t_total, 10))
+    print(f"font:     {t_font :>8.3f}s {100*t_font /t_total:>3.0f}% " + progress_bar(t_font /t_total, 10))
+
+    if trace is not None:
+        print_span_summary()
+        write_trace(trace)
+    return artworks
 
 def progress_bar(filled:float, width:int) -> str:
     blocks = [' ','\u258F','\u258E','\u258D','\u258C','\u258B','\u258A','\u2589','\u2588']
@@ -62,6 +116,61 @@ def progress_bar(filled:float, width:int) -> str:
     bar = f"{full_blocks}{partial_block}".ljust(width)
     return f"\033[100m{bar}\033[m"
 
+### tracing ####################################################################
+
+# Opt-in instrumentation. span() hands out a shared no-op context manager
+# unless --trace is given, so the disabled cost is one global lookup.
+# Thumbnail workers record into their own list and ship it back with the
+# job result; perf_counter_ns is system wide so all spans share a timeline.
+
+@dataclass(slots=True)
+class Span:
+    name  : str
+    start : int
+    dur   : int
+    pid   : int
+    tid   : int
+    args  : dict
+
+tracing = False
+spans:list[Span] = []
+no_span = nullcontext()
+
+def span(name:str, **args):
+    return record_span(name, args) if tracing else no_span
+
+@contextmanager
+def record_span(name:str, args:dict):
+    start = perf_counter_ns()
+    try:
+        yield
+    finally:
+        spans.append(Span(name, start, perf_counter_ns()-start, os.getpid(), get_ident(), args))
+
+def write_trace(path:Path):
+    # Chrome trace event format, open in chrome://tracing or ui.perfetto.dev
+    events = [{
+        'name': s.name,
+        'cat':  'build',
+        'ph':   'X',
+        'ts':   (s.start-perf_epoch)/1000,
+        'dur':  s.dur/1000,
+        'pid':  s.pid,
+        'tid':  s.tid,
+        'args': s.args } for s in spans]
+    path.write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}), encoding="utf-8")
+    print(f"wrote {len(events)} spans to {path}")
+
+def print_span_summary():
+    stages:dict[str,list[int]] = {}
+    for s in spans:
+        stages.setdefault(s.name, []).append(s.dur)
+    width = max([len(name) for name in stages] + [len('stage')])
+    print(f"{'stage'.ljust(width)}  count     total      mean       max")
+    for name,durs in sorted(stages.items(), key=lambda kv: -sum(kv[1])):
+        total = sum(durs)/1000000000
+        print(f"{name.ljust(width)} {len(durs):>6} {total:>8.3f}s {total/len(durs):>8.3f}s {max(durs)/1000000000:>8.3f}s")
+
 ### parsing metadata ###########################################################
 
 @dataclass(slots=True)
@@ -134,6 +243,57 @@ def parse_metadata(yaml_file:Path, img_path:Path) -> list[ArtworkMeta]:
         yaml_artworks.items()))
     return artworks
 
+### integrity check ############################################################
+
+# metadata.yaml records the sha3 of every original to detect bit rot, the
+# length of the digest tells which variant. Originals are hashed through an
+# mmap on a thread pool, hashlib releases the GIL while it works. Digests are
+# cached by path, size and mtime, so only new or touched files are read.
+sha3_variants = {56: sha3_224, 64: sha3_256, 96: sha3_384, 128: sha3_512}
+
+def verify_originals(metas:list[ArtworkMeta], cache_file:Path, jobs:int) -> list[tuple[ArtworkMeta,str]]:
+    try:
+        cached = json.loads(cache_file.read_text(encoding='utf-8'))
+    except (FileNotFoundError, ValueError):
+        cached = {}
+    # entries of originals that are not part of this check are kept while
+    # their file exists, watch mode only verifies what changed
+    entries:dict[str,list] = {k:v for k,v in cached.items() if Path(k).is_file()}
+    todo:list[tuple[ArtworkMeta,list]] = []
+    for meta in metas:
+        stat = meta.path.stat()
+        key = [stat.st_size, stat.st_mtime_ns, len(meta.sha3)]
+        entry = cached.get(str(meta.path))
+        if entry is not None and entry[:3] == key:
+            entries[str(meta.path)] = entry
+        else:
+            todo.append((meta, key))
+
+    with ThreadPoolExecutor(jobs) as pool:
+        digests = pool.map(lambda job: hash_original(job[0].path, len(job[0].sha3)), todo)
+        for (meta,key),digest in zip(todo, digests):
+            entries[str(meta.path)] = key + [digest]
+    print(f"verified {len(metas)} originals, {len(todo)} hashed")
+
+    if entries != cached:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(entries), encoding='utf-8')
+        tmp.replace(cache_file)
+    return [(meta, entries[str(meta.path)][3]) for meta in metas
+            if entries[str(meta.path)][3] != meta.sha3.lower()]
+
+def hash_original(path:Path, digest_len:int) -> str:
+    with span('hash_original', src=path.name):
+        # an unknown length can never match, any variant will do
+        h = sha3_variants.get(digest_len, sha3_256)()
+        with open(path, 'rb') as f:
+            # mmap refuses empty files
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    h.update(m)
+        return h.hexdigest()
+
 ### image handling #############################################################
 
 @dataclass(slots=True)
@@ -141,11 +301,15 @@ class Extent:
     w: int
     h: int
 
+    def __str__(self) -> str:
+        return f'{self.w}x{self.h}'
+
 @dataclass(slots=True)
 class Artwork:
-    meta   : ArtworkMeta
-    size   : Extent
-    thumbs : list[Extent]
+    meta        : ArtworkMeta
+    size        : Extent
+    thumbs      : list[Extent]
+    placeholder : str|None = None # data uri, set once the image stage ran
 
 def thumb_sizes(src:Extent) -> list[Extent]:
     ret = [Extent(src.w, src.h)]
@@ -156,26 +320,518 @@ def thumb_sizes(src:Extent) -> list[Extent]:
         ret.append(Extent(w,h))
     return ret;
 
-def generate_thumbnail(img:Image, size:Extent, path:Path, slug:str, file_extension:str, quality:int) -> None:
-    with img.clone() as o:
-        o.thumbnail(width=size.w, height=size.h)
-        o.compression_quality=quality
-        o.save(filename=path/(slug + f'-{size.w}w.{file_extension}'))
-
-def load_image(meta:ArtworkMeta, write_path:Path|None) -> Artwork:
-    with Image(filename=meta.path) as img:
-        src_size = Extent(img.width, img.height)
-        art = Artwork(
-            meta = meta,
-            size   = src_size,
-            thumbs = list(thumb_sizes(src_size)) )
-        if write_path is not None:
-            print(f"generating {art.meta.slug}")
-            copy(art.meta.path, write_path/art.meta.slug)
-            for thumb_size in art.thumbs:
-                generate_thumbnail(img, thumb_size, write_path, art.meta.slug, 'avif', quality=64)
-                generate_thumbnail(img, thumb_size, write_path, art.meta.slug, 'jpg',  quality=80)
-    return art
+### header probing #############################################################
+
+# Reading the extent of an original only needs its first few bytes. These
+# parsers cover the formats in img/, anything else falls back to ImageMagick.
+
+def probe_size(path:Path) -> Extent|None:
+    with open(path, 'rb') as f:
+        head = f.read(65536)
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return probe_png(head)
+    if head.startswith(b'\xff\xd8'):
+        return probe_jpeg(path)
+    if head[4:8] == b'ftyp' and head[8:12] in (b'avif', b'avis', b'mif1'):
+        return probe_avif(head)
+    return None
+
+def probe_png(head:bytes) -> Extent|None:
+    if len(head) < 24 or head[12:16] != b'IHDR': return None
+    w,h = struct.unpack('>II', head[16:24])
+    return Extent(w,h)
+
+def probe_jpeg(path:Path) -> Extent|None:
+    # walk the marker segments until the first start-of-frame
+    with open(path, 'rb') as f:
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF: return None
+            if marker[1] in (0x01, 0xFF) or 0xD0 <= marker[1] <= 0xD7:
+                f.seek(-1 if marker[1]==0xFF else 0, 1)
+                continue
+            # a truncated file falls back to the image backend
+            segment = f.read(2)
+            if len(segment) < 2: return None
+            length, = struct.unpack('>H', segment)
+            if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                frame = f.read(5)
+                if len(frame) < 5: return None
+                h,w = struct.unpack('>xHH', frame)
+                return Extent(w,h)
+            f.seek(length-2, 1)
+
+def probe_avif(head:bytes) -> Extent|None:
+    # every image item carries an 'ispe' property, tiles, alpha planes and
+    # embedded thumbnails are never larger than the primary item
+    best = None
+    i = head.find(b'ispe')
+    # a box cut off by the end of head is ignored
+    while i >= 4 and i+16 <= len(head):
+        w,h = struct.unpack('>II', head[i+8:i+16])
+        if best is None or w*h > best.w*best.h:
+            best = Extent(w,h)
+        i = head.find(b'ispe', i+4)
+    return best
+
+### thumbnail cache ############################################################
+
+# Thumbnails are stored under a content address: the sha3 of the original
+# from metadata.yaml plus everything that influences the encoded bytes.
+# Entries that were not touched by a full build are evicted at the end of it.
+@dataclass(slots=True)
+class ThumbCache:
+    path : Path
+    used : set[str] = field(default_factory=set)
+
+    def entry(self, meta:ArtworkMeta, size:Extent, file_extension:str, quality:int, cascade:bool,
+              target_bpp:float|None=None, backend:str='wand') -> Path:
+        key = thumb_key(meta, size, file_extension, quality, cascade, target_bpp, backend)
+        self.used.add(key)
+        self.path.mkdir(parents=True, exist_ok=True)
+        return self.path/key
+
+    def evict(self) -> int:
+        if not self.path.is_dir(): return 0
+        stale = [p for p in self.path.iterdir() if p.name not in self.used]
+        for p in stale:
+            p.unlink()
+        return len(stale)
+
+def thumb_key(meta:ArtworkMeta, size:Extent, file_extension:str, quality:int, cascade:bool,
+              target_bpp:float|None=None, backend:str='wand') -> str:
+    resample = '-cascade' if cascade else ''
+    target   = '' if target_bpp is None else f'-bpp{target_bpp:g}'
+    # encoders differ in their output, wand entries keep their old key
+    encoder  = '' if backend == 'wand' else f'-{backend}'
+    return f'{meta.sha3}-{size.w}x{size.h}{resample}-q{quality}{target}{encoder}.{file_extension}'
+
+def link(src:Path, dst:Path):
+    # hard link when possible, www/ and the cache usually share a filesystem
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy(src, dst)
+
+### image backends ###########################################################
+
+# Everything thumbnail generation needs from an imaging library. Images are
+# opaque handles that belong to the backend that opened them. resize() may
+# reuse or release the image it was given, callers continue with the result.
+class ImageBackend(Protocol):
+    def open(self, path:Path): ...
+    def probe(self, path:Path) -> Extent: ...
+    def extent(self, img) -> Extent: ...
+    def copy(self, img): ...
+    def resize(self, img, size:Extent): ...
+    def encode(self, img, file_extension:str, quality:int) -> bytes: ...
+    def close(self, img) -> None: ...
+
+# ImageMagick decodes the whole original up front and shrinks it in place.
+class WandBackend:
+    def open(self, path:Path):
+        from wand.image import Image
+        return Image(filename=path)
+
+    def probe(self, path:Path) -> Extent:
+        from wand.image import Image
+        with Image.ping(filename=path) as img:
+            return Extent(img.width, img.height)
+
+    def extent(self, img) -> Extent:
+        return Extent(img.width, img.height)
+
+    def copy(self, img):
+        return img.clone()
+
+    def resize(self, img, size:Extent):
+        img.thumbnail(width=size.w, height=size.h)
+        return img
+
+    def encode(self, img, file_extension:str, quality:int) -> bytes:
+        img.compression_quality = quality
+        return img.make_blob(file_extension)
+
+    def close(self, img) -> None:
+        img.close()
+
+# Pillow opens lazily and only decodes on the first resize. JPEG originals
+# are then decoded at a reduced scale (draft mode), and large reductions
+# start with a cheap box filter, so peak memory stays close to the first rung.
+class PillowBackend:
+    formats = {'avif': 'AVIF', 'jpg': 'JPEG', 'webp': 'WEBP', 'png': 'PNG'}
+
+    def open(self, path:Path):
+        from PIL import Image
+        return Image.open(path)
+
+    def probe(self, path:Path) -> Extent:
+        from PIL import Image
+        with Image.open(path) as img:
+            return Extent(*img.size)
+
+    def extent(self, img) -> Extent:
+        return Extent(*img.size)
+
+    def copy(self, img):
+        return img.copy()
+
+    def resize(self, img, size:Extent):
+        from PIL import Image
+        img.draft('RGB', (size.w, size.h))
+        src = img
+        if img.mode not in ('RGB', 'RGBA'):
+            src = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+        resized = src.resize((size.w, size.h), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        resized.info['icc_profile'] = img.info.get('icc_profile')
+        if src is not img: src.close()
+        img.close()
+        return resized
+
+    def encode(self, img, file_extension:str, quality:int) -> bytes:
+        from PIL import Image
+        from io import BytesIO
+        fmt = self.formats[file_extension]
+        if fmt == 'JPEG' and img.mode == 'RGBA':
+            # like ImageMagick, flatten transparency onto white
+            flat = Image.new('RGB', img.size, 'white')
+            flat.paste(img, mask=img.getchannel('A'))
+            img = flat
+        out = BytesIO()
+        img.save(out, format=fmt, quality=quality, icc_profile=img.info.get('icc_profile'))
+        return out.getvalue()
+
+    def close(self, img) -> None:
+        img.close()
+
+image_backends:dict[str,type] = {'wand': WandBackend, 'pillow': PillowBackend}
+
+@cache
+def image_backend(name:str) -> ImageBackend:
+    return image_backends[name]()
+
+### thumbnail generation #######################################################
+
+# (file extension, quality) of every thumbnail rung
+thumb_formats = [('avif', 64), ('jpg', 80)]
+
+@dataclass(slots=True)
+class ThumbOutput:
+    size       : Extent
+    quality    : int
+    entry      : Path
+    target_bpp : float|None = None
+
+# Without cascade every output is its own job and resamples the full size
+# original. With cascade a job holds all outputs of one artwork and every rung
+# is resampled from the next larger one, shared by all formats of that rung.
+# Rungs already in the cache are still resampled but not encoded again, so
+# the bytes of a rung never depend on which others an earlier build left.
+# Cores left over when there are fewer cascade jobs than --jobs become
+# threads that encode the rungs of a job while its chain moves on.
+@dataclass(slots=True)
+class ThumbJob:
+    src     : Path
+    sha3    : str
+    outputs : list[ThumbOutput]
+    cascade : bool
+    backend : str
+    threads : int = 1
+
+def save_thumbnail(backend:'ImageBackend', img, path:Path, quality:int, target_bpp:float|None=None) -> None:
+    if target_bpp is not None:
+        data = encode_for_target(backend, img, path.suffix[1:], quality, target_bpp)
+    else:
+        with span('encode', size=str(backend.extent(img)), format=path.suffix[1:], quality=quality):
+            data = backend.encode(img, path.suffix[1:], quality)
+    # write next to the final name and rename, so an interrupted build
+    # never leaves a truncated file behind in the cache
+    tmp = path.with_suffix('.tmp' + path.suffix)
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+# the lowest quality a --target-bpp search may pick
+min_target_quality = 30
+
+def encode_for_target(backend:'ImageBackend', img, file_extension:str, quality:int, target_bpp:float) -> bytes:
+    # Bisects for the highest quality up to the configured one whose output
+    # stays within the budget. If none does, the lowest quality is used.
+    size = backend.extent(img)
+    budget = target_bpp*size.w*size.h
+    def encode(q:int) -> bytes:
+        with span('encode', size=str(size), format=file_extension, quality=q):
+            return backend.encode(img, file_extension, q)
+    # the configured quality often fits already
+    data = encode(quality)
+    if len(data) <= budget: return data
+    best = None
+    lo, hi = min_target_quality, quality-1
+    while lo <= hi:
+        q = (lo+hi)//2
+        data = encode(q)
+        if len(data) <= budget:
+            best, lo = data, q+1
+        else:
+            hi = q-1
+    # when nothing fits the last attempt was the lowest quality
+    return best if best is not None else data
+
+def generate_thumbnail(backend:'ImageBackend', img, size:Extent, path:Path, quality:int,
+                       target_bpp:float|None=None) -> None:
+    with span('generate_thumbnail', size=str(size), format=path.suffix[1:]):
+        with span('resize', size=str(size)):
+            o = backend.resize(backend.copy(img), size)
+        try:
+            save_thumbnail(backend, o, path, quality, target_bpp)
+        finally:
+            backend.close(o)
+
+def generate_cascade(backend:'ImageBackend', img, outputs:list[ThumbOutput], threads:int=1):
+    rungs:dict[tuple[int,int],list[ThumbOutput]] = {}
+    for out in sorted(outputs, key=lambda o: o.size.w, reverse=True):
+        rungs.setdefault((out.size.w,out.size.h), []).append(out)
+    # The job owns img, so every rung is shrunk from the last one instead of
+    # from a copy of the original. Encoders keep per call state on the image
+    # and release the GIL, so on threads every encode gets its own copy.
+    pool = ThreadPoolExecutor(threads) if threads > 1 else None
+    try:
+        encodes = []
+        for (w,h),outs in rungs.items():
+            with span('resize', size=f'{w}x{h}'):
+                img = backend.resize(img, Extent(w,h))
+            for out in outs:
+                if out.entry.exists():
+                    continue
+                elif pool is None:
+                    save_thumbnail(backend, img, out.entry, out.quality, out.target_bpp)
+                else:
+                    encodes.append(pool.submit(save_rung, backend, backend.copy(img), out))
+        for encode in encodes:
+            encode.result()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return img
+
+def save_rung(backend:'ImageBackend', img, out:ThumbOutput) -> None:
+    try:
+        save_thumbnail(backend, img, out.entry, out.quality, out.target_bpp)
+    finally:
+        backend.close(img)
+
+# the last original decoded by this process, jobs of one artwork are queued
+# back to back so a worker can often reuse it. It is keyed by the sha3 too,
+# an original edited in place must never be encoded from its old pixels.
+decoded:tuple[tuple[Path,str,str],object]|None = None
+
+def release_decoded():
+    global decoded
+    if decoded is not None:
+        image_backend(decoded[0][2]).close(decoded[1])
+        decoded = None
+
+def init_worker(trace:bool):
+    global tracing
+    tracing = trace
+
+def run_thumb_job(job:ThumbJob) -> list[Span]:
+    mark = len(spans)
+    with span('thumb_job', src=job.src.name, outputs=len(job.outputs), cascade=job.cascade, backend=job.backend):
+        run_thumb_outputs(job)
+    # hand the spans of this job to the caller, which may be another process
+    job_spans = spans[mark:]
+    del spans[mark:]
+    return job_spans
+
+def run_thumb_outputs(job:ThumbJob) -> None:
+    global decoded
+    backend = image_backend(job.backend)
+    if job.cascade:
+        with span('decode', src=job.src.name):
+            img = backend.open(job.src)
+        try:
+            img = generate_cascade(backend, img, job.outputs, job.threads)
+        finally:
+            backend.close(img)
+        return
+    key = (job.src, job.sha3, job.backend)
+    if decoded is None or decoded[0] != key:
+        release_decoded()
+        with span('decode', src=job.src.name):
+            decoded = (key, backend.open(job.src))
+    for out in job.outputs:
+        generate_thumbnail(backend, decoded[1], out.size, out.entry, out.quality, out.target_bpp)
+
+def load_image(meta:ArtworkMeta, backend:str='wand') -> Artwork:
+    with span('load_image', slug=meta.slug):
+        src_size = probe_size(meta.path)
+        if src_size is None:
+            src_size = image_backend(backend).probe(meta.path)
+    return Artwork(
+        meta = meta,
+        size   = src_size,
+        thumbs = list(thumb_sizes(src_size)) )
+
+# How thumbnails are encoded and named in www/. A hashed name carries a
+# digest of the cache key, so it always refers to the same bytes and may be
+# cached forever. With a target, every rung gets the highest quality that
+# stays within target_bpp bytes per pixel. The adaptive ladder drops rungs
+# that are barely larger than the next smaller one.
+@dataclass(frozen=True, slots=True)
+class ThumbOptions:
+    hashed     : bool = False
+    cascade    : bool = True
+    adaptive   : bool = False
+    target_bpp : float|None = None
+    backend    : str = 'wand'
+
+    def entry(self, cache:ThumbCache, art:Artwork, size:Extent, file_extension:str) -> Path:
+        quality = dict(thumb_formats)[file_extension]
+        return cache.entry(art.meta, size, file_extension, quality, self.cascade, self.target_bpp, self.backend)
+
+def thumb_name(art:Artwork, size:Extent, file_extension:str, options:ThumbOptions=ThumbOptions()) -> str:
+    if not options.hashed:
+        return art.meta.slug + f'-{size.w}w.{file_extension}'
+    quality = dict(thumb_formats)[file_extension]
+    key = thumb_key(art.meta, size, file_extension, quality, options.cascade, options.target_bpp, options.backend)
+    digest = sha3_256(key.encode('utf-8')).hexdigest()[:16]
+    return art.meta.slug + f'-{size.w}w.{digest}.{file_extension}'
+
+# A blurry stand-in shown behind every <img> until a srcset candidate has
+# arrived. It is encoded with the thumbnails as one more, very small rung,
+# so with cascade it is resampled from the smallest real one.
+placeholder_format = ('webp', 30)
+placeholder_width  = 16
+
+def placeholder_size(src:Extent) -> Extent:
+    w = min(placeholder_width, src.w)
+    return Extent(w, max(1, round(w*src.h/src.w)))
+
+def placeholder_entry(cache:ThumbCache, art:Artwork, options:ThumbOptions) -> Path:
+    file_extension, quality = placeholder_format
+    size = placeholder_size(art.size)
+    return cache.entry(art.meta, size, file_extension, quality, options.cascade, backend=options.backend)
+
+def load_placeholder(entry:Path) -> str|None:
+    if not entry.exists(): return None
+    return f'data:image/{placeholder_format[0]};base64,' + b64encode(entry.read_bytes()).decode('ascii')
+
+def generate_images(artworks:list[Artwork], write_path:Path, cache:ThumbCache, jobs:int, options:ThumbOptions) -> None:
+    cascade = options.cascade
+    todo:list[ThumbJob] = []
+    names:list[str] = []
+    for art in artworks:
+        copy(art.meta.path, write_path/art.meta.slug)
+        outputs:list[ThumbOutput] = []
+        labels:list[str] = []
+        # every candidate rung, the chain must not depend on the ladder
+        for thumb_size in thumb_sizes(art.size):
+            for file_extension,quality in thumb_formats:
+                entry = options.entry(cache, art, thumb_size, file_extension)
+                outputs.append(ThumbOutput(thumb_size, quality, entry, options.target_bpp))
+                labels.append(thumb_name(art, thumb_size, file_extension, options))
+        entry = placeholder_entry(cache, art, options)
+        outputs.append(ThumbOutput(placeholder_size(art.size), placeholder_format[1], entry))
+        labels.append(f'{art.meta.slug} (placeholder)')
+        missing = [i for i,out in enumerate(outputs) if not out.entry.exists()]
+        if not cascade:
+            for i in missing:
+                todo.append(ThumbJob(art.meta.path, art.meta.sha3, outputs[i:i+1], cascade, options.backend))
+                names.append(labels[i])
+        elif len(missing) > 0:
+            todo.append(ThumbJob(art.meta.path, art.meta.sha3, outputs, cascade, options.backend))
+            names.append(f'{art.meta.slug} ({len(missing)} thumbnails)')
+
+    if cascade:
+        for job in todo:
+            job.threads = max(1, jobs//max(1, len(todo)))
+    print(f"running {len(todo)} thumbnail jobs on {jobs} cores")
+    parallel = jobs > 1 and len(todo) > 1
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(tracing,)) \
+         if parallel else nullcontext() as pool:
+        results = pool.map(run_thumb_job, todo) if parallel else map(run_thumb_job, todo)
+        # map yields in submission order, so progress prints deterministically
+        width = len(str(len(todo)))
+        try:
+            for i,(name,job_spans) in enumerate(zip(names, results)):
+                spans.extend(job_spans)
+                print(f"[{i+1:>{width}}/{len(todo)}] {name}")
+        finally:
+            # a serial run decodes in this process, do not keep the original
+            # alive beyond this stage
+            release_decoded()
+
+    load_cached(artworks, cache, options)
+    for art in artworks:
+        for thumb_size in art.thumbs:
+            for file_extension,_ in thumb_formats:
+                entry = options.entry(cache, art, thumb_size, file_extension)
+                link(entry, write_path/thumb_name(art, thumb_size, file_extension, options))
+
+# The ladder and the placeholder of an artwork follow from its encoded
+# thumbnails, so they are read back from the cache once those exist.
+def load_cached(artworks:list[Artwork], cache:ThumbCache, options:ThumbOptions) -> None:
+    for art in artworks:
+        if options.adaptive:
+            art.thumbs = adaptive_ladder(art, cache, options)
+        art.placeholder = load_placeholder(placeholder_entry(cache, art, options))
+
+# A rung is kept only if its encodings together are at least this much
+# larger than those of the next smaller kept rung, otherwise the browser
+# might as well fetch the larger one. The smallest and the full size rung
+# are always kept, the one below the full size gives way if it is too close.
+adaptive_min_gain = 0.25
+
+def adaptive_ladder(art:Artwork, cache:ThumbCache, options:ThumbOptions) -> list[Extent]:
+    candidates = thumb_sizes(art.size)
+    entries = [[options.entry(cache, art, size, ext) for ext,_ in thumb_formats] for size in candidates]
+    if not all(e.exists() for es in entries for e in es):
+        # --skip-images without a previous full build
+        return candidates
+    nbytes = [sum(e.stat().st_size for e in es) for es in entries]
+    order = sorted(range(len(candidates)), key=lambda i: candidates[i].w)
+    kept = order[:1]
+    for i in order[1:]:
+        if nbytes[i] >= (1+adaptive_min_gain)*nbytes[kept[-1]]:
+            kept.append(i)
+        elif i == order[-1]:
+            if len(kept) > 1: kept.pop()
+            kept.append(i)
+    return [candidates[i] for i in sorted(kept)]
+
+### templates ##################################################################
+
+# A template is parsed once into literal text and placeholder names, with
+# leading and trailing whitespace of every line already stripped. Rendering
+# appends the pieces to a list in a single pass, a value may itself be a list
+# of pieces so nested fragments are never joined into intermediate strings.
+# Unknown placeholders are kept verbatim.
+@dataclass(slots=True)
+class Template:
+    parts : list[str] # literal text at even, placeholder names at odd indices
+
+def compile_template(source:str) -> Template:
+    return Template(re.split(r'\{(\w+)\}', strip_lines(source)))
+
+def render_into(out:list[str], template:Template, values:dict[str,str|list[str]]):
+    parts = template.parts
+    out.append(parts[0])
+    for i in range(1, len(parts), 2):
+        value = values.get(parts[i])
+        if value is None:
+            out.append('{' + parts[i] + '}')
+        elif type(value) is list:
+            out.extend(value)
+        else:
+            out.append(value)
+        out.append(parts[i+1])
+
+def render(template:Template, **values:str|list[str]) -> str:
+    out:list[str] = []
+    render_into(out, template, values)
+    return ''.join(out)
 
 ### html generation ############################################################
 
@@ -186,130 +842,626 @@ class CssVariables:
     width_refsheet : int
     width_gallery  : int
 
-def gen_html(artworks:list[Artwork], src_path:Path, pretty:bool) -> str:
+# The page is built in stages so watch mode can redo only what an edit
+# invalidates: figures depend on the artworks and the css variables, the
+# page on the figures and the sources in src/.
+@dataclass(slots=True)
+class Sources:
+    style_css  : str
+    index_html : Template
+    icons_svg  : str
+
+@dataclass(slots=True)
+class Figures:
+    pfp      : str
+    refsheet : str
+    gallery  : list[str]
+
+def gen_html(artworks:list[Artwork], src_path:Path, pretty:bool, page_size:int|None=None,
+             options:ThumbOptions=ThumbOptions()) -> tuple[str,list[list[str]]]:
+    sources = read_sources(src_path)
+    figures = gen_figures(artworks, css_variables(sources.style_css), options)
+    figures, chunks = paginate(figures, page_size)
+    return gen_page(sources, figures, pretty, chunks), chunks
+
+def read_sources(src_path:Path) -> Sources:
     def read_txt(filename:str) -> str:
         return (src_path/filename).read_text(encoding="utf-8")
 
-    style_css = read_txt("style.css")
-    css = CssVariables(
+    with span('read_sources'):
+        return Sources(
+            style_css  = read_txt("style.css"),
+            index_html = compile_template(read_txt("index.html")),
+            icons_svg  = strip_lines(read_txt("icons.svg")))
+
+def css_variables(style_css:str) -> CssVariables:
+    return CssVariables(
         gutter         = extract_css_variable_px(style_css, "gutter"),
         width_pfp      = extract_css_variable_px(style_css, "width-pfp"),
         width_refsheet = extract_css_variable_px(style_css, "width-refsheet"),
         width_gallery  = extract_css_variable_px(style_css, "width-gallery"))
 
-    if not pretty:
-        style_css = preprocess_css(style_css)
-
+def gen_figures(artworks:list[Artwork], css:CssVariables, options:ThumbOptions=ThumbOptions()) -> Figures:
     gallery_html = []
     refsheet_html = ""
     pfp_html = ""
-    for artwork in artworks:
-        match artwork.meta.category:
-            case ArtworkCategory.pfp:
-                pfp_html = gen_html_pfp(artwork, css)
-                gallery_html.append(gen_html_figure(artwork, css))
-            case ArtworkCategory.refsheet:
-                refsheet_html = gen_html_figure(artwork, css)
-            case ArtworkCategory.regular:
-                gallery_html.append(gen_html_figure(artwork, css))
-
-    return resolve(strip_lines(read_txt("index.html")), 
-                   title = "Snipsel's Cozy Corner of the Internet",
-                   style = style_css,
-                   svg = strip_lines(read_txt("icons.svg")),
-                   pfp = strip_lines(pfp_html),
-                   refsheet = strip_lines(refsheet_html),
-                   gallery = strip_lines(''.join(gallery_html)),
-                   githash = git_short_hash() )
+    with span('gen_figures', count=len(artworks)):
+        for artwork in artworks:
+            match artwork.meta.category:
+                case ArtworkCategory.pfp:
+                    pfp_html = gen_html_pfp(artwork, css, options)
+                    gallery_html.append(gen_html_figure(artwork, css, options))
+                case ArtworkCategory.refsheet:
+                    refsheet_html = gen_html_figure(artwork, css, options)
+                case ArtworkCategory.regular:
+                    gallery_html.append(gen_html_figure(artwork, css, options))
+    return Figures(pfp_html, refsheet_html, gallery_html)
+
+def gen_page(sources:Sources, figures:Figures, pretty:bool, chunks:list[list[str]]=[]) -> str:
+    style_css, icons_svg = sources.style_css, sources.icons_svg
+    if not pretty:
+        with span('eliminate_dead_code'):
+            page = PageInventory()
+            for fragment in sources.index_html.parts[0::2]:
+                page.feed(fragment)
+            for fragment in [figures.pfp, figures.refsheet, *figures.gallery, *(f for c in chunks for f in c)]:
+                page.feed(fragment)
+            icons_svg = prune_sprite(icons_svg, page.refs)
+            page.feed(icons_svg)
+            page.close()
+            style_css = serialize_css(prune_css(parse_css(tokenize_css(style_css)), page))
 
+    with span('git_short_hash'):
+        githash = git_short_hash()
+
+    with span('render_page'):
+        return render(sources.index_html,
+                      title = "Snipsel's Cozy Corner of the Internet",
+                      style = style_css,
+                      svg = icons_svg,
+                      pfp = figures.pfp,
+                      refsheet = figures.refsheet,
+                      gallery = figures.gallery,
+                      githash = githash )
 
 def extract_css_variable_px(source:str, var:str):
     match = re.search(f'--{var}\s*:\s*([0-9]+)px\s*;', source)
     return int(match.groups(1)[0])
 
-def preprocess_css(css_source:str) -> str:
-    # strip comments
-    ret = re.sub('/\*(?:.*?)\*/', '', css_source)
+def strip_lines(s:str):
+    return ''.join(map(lambda x: x.strip(), s.splitlines()))
 
-    # remove whitespace
-    ret = strip_lines(ret)
+# the hash cannot change while a build runs, watch mode reuses it too
+@cache
+def git_short_hash() -> str:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('ascii').strip().upper()
 
-    # remove spaces after : and ,
-    ret = re.sub(':\s+', ':', ret)
-    ret = re.sub(',\s+', ',', ret)
+artist_link_template = compile_template("""
+    <a href="{link}">
+        <svg>
+            <use href="#icon-{kind}"/>
+        </svg>
+    </a>""")
 
-    # remove last ; in list
-    ret = re.sub(';\s*}', '}', ret)
+picture_template = compile_template("""
+    <picture>
+      <source type="image/avif" sizes="{sizes}" srcset="{srcset_avif}">
+      <source type="image/jpeg" sizes="{sizes}" srcset="{srcset_jpg}">
+      <img width="{w}" height="{h}" src="{fallback}" alt="{alt}"{placeholder}>
+    </picture>""")
 
-    return ret
+figure_template = compile_template("""
+    <figure id="{slug}" class="artwork">
+      <a href="{slug}">
+        {picture}
+      </a>
+      <figcaption>
+        {artist}
+        {links}
+        <time datetime="{date}">{month} {yyyy}</time>
+      </figcaption>
+    </figure>""")
 
-def resolve(template:str, **replacements: dict[str,str]):
-    for tag,repl in replacements.items():
-        template = template.replace('{'+tag+'}', repl);
-    return template
+pfp_template = compile_template("""
+    <figure id="pfp" class="artwork">
+      {picture}
+    </figure>""")
 
-def strip_lines(s:str):
-    return ''.join(map(lambda x: x.strip(), s.splitlines()))
+months = [None, "Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
 
-def git_short_hash() -> str:
-    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('ascii').strip().upper()
-
-def subset_font(infont:str, outfont:str):
-    subset.main([
-        infont,
-        '--flavor=woff2',
-       f'--output-file={outfont}',
-        '--layout-features=kern,liga,onum',
-        '--desubroutinize',
-        '--no-hinting',
-        '--text="0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz@_!,’"'])
-
-def gen_artist_links(artist:Artist) -> str:
-    html = ""
+def gen_artist_links(artist:Artist) -> list[str]:
+    out:list[str] = []
     for kind,link in artist.links.items():
-        html += f"""
-            <a href="{link}">
-                <svg>
-                    <use href="#icon-{kind}"/>
-                </svg>
-            </a>"""
-    return html
-
-def gen_html_picture(art:Artwork, css:CssVariables):
+        render_into(out, artist_link_template, {'link': link, 'kind': kind})
+    return out
+
+def gen_html_picture(art:Artwork, css:CssVariables, options:ThumbOptions) -> list[str]:
     sizes = art.meta.category.match(
         pfp      = f'min(100vw - {2*css.gutter}px,{css.width_pfp     }px)',
         refsheet = f'min(100vw - {2*css.gutter}px,{css.width_refsheet}px)',
         regular  = f'min(100vw - {2*css.gutter}px,{css.width_gallery }px)')
-    mini_jpg  = ','.join([f'{art.meta.slug}-{e.w}w.jpg {e.w}w' for e in art.thumbs])
-    mini_avif = ','.join([f'{art.meta.slug}-{e.w}w.avif {e.w}w' for e in art.thumbs])
+    # browsers without srcset support get the rung closest to 400px wide
+    fallback = min(art.thumbs, key=lambda e: abs(e.w-400))
+    out:list[str] = []
+    render_into(out, picture_template, {
+        'sizes'       : sizes,
+        'srcset_avif' : ','.join([f'{thumb_name(art, e, "avif", options)} {e.w}w' for e in art.thumbs]),
+        'srcset_jpg'  : ','.join([f'{thumb_name(art, e, "jpg", options)} {e.w}w' for e in art.thumbs]),
+        'w'           : str(art.size.w),
+        'h'           : str(art.size.h),
+        'fallback'    : thumb_name(art, fallback, 'jpg', options),
+        'placeholder' : '' if art.placeholder is None else
+                        f' style="background:url({art.placeholder}) 0/cover" onload="this.removeAttribute(\'style\')"',
+        'alt'         : art.meta.alt })
+    return out
 
-    return f"""
-        <picture>
-          <source type="image/avif" sizes="{sizes}" srcset="{mini_avif}">
-          <source type="image/jpeg" sizes="{sizes}" srcset="{mini_jpg}">
-          <img width="{art.size.w}" height="{art.size.h}" src="{art.meta.slug}-400w.jpg" alt="{art.meta.alt}">
-        </picture>"""
-
-def gen_html_figure(art:Artwork, css_vars:CssVariables) -> str:
+def gen_html_figure(art:Artwork, css_vars:CssVariables, options:ThumbOptions) -> str:
     yyyy,mm,dd = art.meta.date.split(' ')[0].split('-')
-    month = [None, "Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"][int(mm)]
-    return f"""
-        <figure id="{art.meta.slug}" class="artwork">
-          <a href="{art.meta.slug}">
-            {gen_html_picture(art,css_vars)}
-          </a>
-          <figcaption>
-            {art.meta.artist.name}
-            {gen_artist_links(art.meta.artist)}
-            <time datetime="{art.meta.date}">{month} {yyyy}</time>
-          </figcaption>
-        </figure>"""
-
-def gen_html_pfp(art:Artwork, css_vars:CssVariables) -> str:
-    return f"""
-        <figure id="pfp" class="artwork">
-          {gen_html_picture(art,css_vars)}
-        </figure>"""
+    return render(figure_template,
+        slug    = art.meta.slug,
+        picture = gen_html_picture(art,css_vars,options),
+        artist  = art.meta.artist.name,
+        links   = gen_artist_links(art.meta.artist),
+        date    = art.meta.date,
+        month   = months[int(mm)],
+        yyyy    = yyyy)
+
+def gen_html_pfp(art:Artwork, css_vars:CssVariables, options:ThumbOptions) -> str:
+    return render(pfp_template, picture=gen_html_picture(art,css_vars,options))
+
+### dead-code elimination ######################################################
+
+# The sprite and the stylesheet are inlined into every page, so whatever the
+# page does not use is dropped first. The page and its gallery chunks are
+# scanned for the tags, ids and classes they contain and the #ids they link
+# to. Symbols nobody links to are removed, and so are selectors that require
+# a tag, id or class the page lacks. Pseudo-classes, attributes and
+# combinators are not evaluated, a selector is only dropped when it cannot
+# possibly match.
+
+class PageInventory(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.tags:set[str]    = set()
+        self.ids:set[str]     = set()
+        self.classes:set[str] = set()
+        self.refs:set[str]    = set()
+
+    def handle_starttag(self, tag, attrs):
+        self.tags.add(tag)
+        for name,value in attrs:
+            if value is None: continue
+            if name == 'id':
+                self.ids.add(value)
+            elif name == 'class':
+                self.classes.update(value.split())
+            # href="#icon-x", fill="url(#pattern)", ...
+            self.refs.update(re.findall(r'#([\w-]+)', value))
+
+symbol_pattern = re.compile(r'<symbol\b[^>]*?\bid="([^"]*)".*?</symbol>', re.S)
+
+def prune_sprite(svg:str, refs:set[str]) -> str:
+    # symbols may use each other, links inside the sprite count as well
+    refs = refs | set(re.findall(r'#([\w-]+)', svg))
+    return symbol_pattern.sub(lambda m: m.group(0) if m.group(1) in refs else '', svg)
+
+# A tokenizer after CSS Syntax Level 3, simplified where this stylesheet
+# cannot tell the difference. Every character ends up in exactly one token.
+css_ident = r'(?:--|-?(?:[^\W\d]|\\.))(?:[\w-]|\\.)*'
+css_token_pattern = re.compile(rf'''
+    (?P<comment>  /\*.*?(?:\*/|$) )
+  | (?P<space>    \s+ )
+  | (?P<string>   "(?:[^"\\\n]|\\.)*"? | '(?:[^'\\\n]|\\.)*'? )
+  | (?P<url>      url\(\s*[^"'()\s]*\s*\) )
+  | (?P<number>   [+-]?(?:[0-9]*\.[0-9]+|[0-9]+)(?:[eE][+-]?[0-9]+)?(?:%|{css_ident})? )
+  | (?P<function> {css_ident}\( )
+  | (?P<at>       @{css_ident} )
+  | (?P<hash>     \#(?:[\w-]|\\.)+ )
+  | (?P<ident>    {css_ident} )
+  | (?P<punct>    [{{}}()\[\];:,] )
+  | (?P<delim>    . )''', re.S | re.X)
+
+CssToken = tuple[str,str] # (kind, text)
+
+def tokenize_css(source:str) -> list[CssToken]:
+    return [(m.lastgroup, m.group()) for m in css_token_pattern.finditer(source)]
+
+# The body of a rule is either declarations or, for the at-rules below, more
+# rules. Rules nested in a style rule are kept as declaration tokens.
+@dataclass(slots=True)
+class CssRule:
+    prelude      : list[CssToken]
+    declarations : list[CssToken]|None = None
+    rules        : list['CssRule']|None = None
+
+    def at_keyword(self) -> str|None:
+        kind,text = self.prelude[0] if len(self.prelude) > 0 else ('','')
+        return text.lower() if kind == 'at' else None
+
+nested_at_rules = {'@media','@supports','@container','@layer','@document','@keyframes','@-webkit-keyframes'}
+# rules inside these are matched against the page, keyframe selectors are not
+conditional_at_rules = {'@media','@supports','@container','@layer','@document'}
+
+def parse_css(tokens:list[CssToken], i:int=0) -> list[CssRule]:
+    rules, _ = parse_css_rules(tokens, i)
+    return rules
+
+def parse_css_rules(tokens:list[CssToken], i:int) -> tuple[list[CssRule],int]:
+    rules:list[CssRule] = []
+    prelude:list[CssToken] = []
+    while i < len(tokens):
+        kind,text = tokens[i]
+        i += 1
+        if len(prelude) == 0 and kind in ('space','comment'):
+            continue
+        elif kind == 'punct' and text == '}':
+            break
+        elif kind == 'punct' and text == ';':
+            rules.append(CssRule(prelude))
+            prelude = []
+        elif kind == 'punct' and text == '{':
+            rule = CssRule(prelude)
+            if rule.at_keyword() in nested_at_rules:
+                rule.rules, i = parse_css_rules(tokens, i)
+            else:
+                rule.declarations, i = css_block(tokens, i)
+            rules.append(rule)
+            prelude = []
+        else:
+            prelude.append((kind,text))
+    if len(prelude) > 0:
+        rules.append(CssRule(prelude))
+    return rules, i
+
+def css_block(tokens:list[CssToken], i:int) -> tuple[list[CssToken],int]:
+    start, depth = i, 1
+    while i < len(tokens):
+        kind,text = tokens[i]
+        i += 1
+        if kind == 'punct' and text == '{': depth += 1
+        if kind == 'punct' and text == '}': depth -= 1
+        if depth == 0: return tokens[start:i-1], i
+    return tokens[start:], i
+
+def prune_css(rules:list[CssRule], page:PageInventory) -> list[CssRule]:
+    kept:list[CssRule] = []
+    for rule in rules:
+        at = rule.at_keyword()
+        if at is None:
+            selectors = [s for s in split_css_commas(rule.prelude) if selector_may_match(s, page)]
+            if len(selectors) == 0: continue
+            prelude = [t for s in selectors for t in [('punct',','), *s]][1:]
+            rule = CssRule(prelude, rule.declarations, rule.rules)
+        elif at in conditional_at_rules and rule.rules is not None:
+            nested = prune_css(rule.rules, page)
+            if len(nested) == 0: continue
+            rule = CssRule(rule.prelude, rule.declarations, nested)
+        kept.append(rule)
+    return kept
+
+def split_css_commas(tokens:list[CssToken]) -> list[list[CssToken]]:
+    parts:list[list[CssToken]] = [[]]
+    depth = 0
+    for kind,text in tokens:
+        if kind == 'function' or text in ('(','['): depth += 1
+        if kind == 'punct' and text in (')',']'):  depth -= 1
+        if kind == 'punct' and text == ',' and depth == 0:
+            parts.append([])
+        else:
+            parts[-1].append((kind,text))
+    return parts
+
+def selector_may_match(selector:list[CssToken], page:PageInventory) -> bool:
+    i = 0
+    while i < len(selector):
+        kind,text = selector[i]
+        if kind == 'function' or (kind == 'punct' and text in ('(','[')):
+            # arguments of :not(), :is(), ... and attribute selectors
+            i = skip_css_group(selector, i)
+            continue
+        elif kind == 'punct' and text == ':':
+            i += 1
+            if i < len(selector) and selector[i] == ('punct',':'):
+                i += 1
+            if i < len(selector) and selector[i][0] == 'function':
+                i = skip_css_group(selector, i)
+            else:
+                i += 1
+            continue
+        elif kind == 'delim' and text == '.' and i+1 < len(selector) and selector[i+1][0] == 'ident':
+            if selector[i+1][1] not in page.classes: return False
+            i += 2
+            continue
+        elif kind == 'hash' and text[1:] not in page.ids:
+            return False
+        elif kind == 'ident' and text.lower() not in page.tags:
+            return False
+        elif kind == 'delim' and text == '|':
+            # namespaces are not worth understanding
+            return True
+        i += 1
+    return True
+
+def skip_css_group(tokens:list[CssToken], i:int) -> int:
+    depth = 0
+    while i < len(tokens):
+        kind,text = tokens[i]
+        i += 1
+        if kind == 'function' or (kind == 'punct' and text in ('(','[')): depth += 1
+        if kind == 'punct' and text in (')',']'): depth -= 1
+        if depth == 0: break
+    return i
+
+def serialize_css(rules:list[CssRule]) -> str:
+    out:list[str] = []
+    for rule in rules:
+        out.append(minify_css_tokens(rule.prelude, 'prelude' if rule.at_keyword() else 'selector'))
+        if rule.rules is not None:
+            out += ['{', serialize_css(rule.rules), '}']
+        elif rule.declarations is not None:
+            declarations = rule.declarations
+            # the last declaration needs no semicolon
+            while len(declarations) > 0 and (declarations[-1][0] in ('space','comment') or declarations[-1] == ('punct',';')):
+                declarations = declarations[:-1]
+            out += ['{', minify_css_tokens(declarations, 'declarations'), '}']
+        else:
+            out.append(';')
+    return ''.join(out)
+
+# Whitespace and comments collapse into a single space, which is dropped
+# wherever both neighbours are unambiguous without it. Inside selectors a
+# space before ':' is a descendant combinator and must stay, in values the
+# spaces around + and - in calc() are required.
+def minify_css_tokens(tokens:list[CssToken], context:str) -> str:
+    out:list[str] = []
+    prev:CssToken|None = None
+    space = False
+    for kind,text in tokens:
+        if kind in ('space','comment'):
+            space = True
+            continue
+        if space and prev is not None and css_space_needed(prev, (kind,text), context):
+            out.append(' ')
+        if kind == 'number':
+            # 0.5em is .5em
+            text = re.sub(r'^([+-]?)0+\.', r'\1.', text)
+        out.append(text)
+        prev, space = (kind,text), False
+    return ''.join(out)
+
+def css_space_needed(prev:CssToken, next:CssToken, context:str) -> bool:
+    for kind,text in (prev,next):
+        if kind == 'punct' and text in ',;{}':
+            return False
+        if context == 'declarations' and kind == 'punct' and text == ':':
+            return False
+        if context == 'selector' and kind == 'delim' and text in '>+~':
+            return False
+    return True
+
+### gallery pagination #########################################################
+
+# With a page size only the first figures of the gallery are inlined. The
+# rest goes into gallery-N.json chunks, each a JSON list of figure markup,
+# which the loader script appends as the visitor scrolls towards the end.
+# If the url points at a #slug that is not on the page yet, every chunk is
+# fetched at once and the figure is scrolled into view once it exists.
+
+loader_template = compile_template("""
+    <div id="gallery-more" data-chunks="{chunks}"></div>
+    <script>
+      (()=>{
+      let m=document.getElementById('gallery-more'),c=m.dataset.chunks.split(','),n=0,v=false,q=Promise.resolve(),f={};
+      const get=i=>f[i]??=fetch(c[i]).then(r=>r.json());
+      const load=k=>q=q.then(async()=>{
+        while(n<k&&n<c.length)m.insertAdjacentHTML('beforebegin',(await get(n++)).join(''));
+        if(v&&n<c.length)load(n+1)});
+      const find=()=>{
+        let h=decodeURIComponent(location.hash.slice(1));
+        if(h&&!document.getElementById(h)){
+          c.forEach((_,i)=>get(i));
+          load(c.length).then(()=>document.getElementById(h)?.scrollIntoView())}};
+      new IntersectionObserver(e=>{v=e[0].isIntersecting;if(v)load(n+1)},{rootMargin:'100%'}).observe(m);
+      addEventListener('hashchange',find);find();
+      })();
+    </script>""")
+
+def chunk_name(i:int) -> str:
+    return f'gallery-{i+1}.json'
+
+def paginate(figures:Figures, page_size:int|None) -> tuple[Figures,list[list[str]]]:
+    if page_size is None or len(figures.gallery) <= page_size:
+        return figures, []
+    rest = figures.gallery[page_size:]
+    chunks = [rest[i:i+page_size] for i in range(0, len(rest), page_size)]
+    loader = render(loader_template, chunks=','.join(chunk_name(i) for i in range(len(chunks))))
+    return Figures(figures.pfp, figures.refsheet, figures.gallery[:page_size] + [loader]), chunks
+
+def write_chunks(dst_path:Path, chunks:list[list[str]]):
+    for stale in dst_path.glob('gallery-*.json*'):
+        stale.unlink()
+    for i,chunk in enumerate(chunks):
+        (dst_path/chunk_name(i)).write_text(json.dumps(chunk, separators=(',',':')), encoding="utf-8")
+
+### font subsetting ############################################################
+
+font_options = [
+    '--flavor=woff2',
+    '--layout-features=kern,liga,onum',
+    '--desubroutinize',
+    '--no-hinting']
+
+# Only glyphs that are actually rendered with the font are kept. The subset
+# is cached under a hash of the font, the options and the glyph set, so a
+# build that adds no new characters just copies the previous result.
+def subset_font(infont:Path, outfont:Path, text:str, cache_path:Path):
+    key = sha3_256(infont.read_bytes())
+    key.update('\0'.join(font_options + [text]).encode('utf-8'))
+    entry = cache_path/(key.hexdigest()[:32] + '.woff2')
+    if not entry.exists():
+        from fontTools import subset
+        cache_path.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_suffix('.tmp.woff2')
+        subset.main([str(infont), *font_options, f'--output-file={tmp}', f'--text={text}'])
+        tmp.replace(entry)
+        for stale in cache_path.iterdir():
+            if stale != entry: stale.unlink()
+    copy(entry, outfont)
+
+class VisibleTextParser(HTMLParser):
+    # text inside these is never drawn with the page font
+    hidden_tags = {'head','style','svg','script'}
+
+    def __init__(self):
+        super().__init__()
+        self.hidden = 0
+        self.chars:set[str] = set()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.hidden_tags: self.hidden += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.hidden_tags: self.hidden -= 1
+
+    def handle_data(self, data):
+        if self.hidden == 0: self.chars.update(data)
+
+def visible_text(html:str) -> str:
+    parser = VisibleTextParser()
+    parser.feed(html)
+    parser.close()
+    # the footer shows the git hash, keep every hex digit so a new commit
+    # does not invalidate the cached subset
+    return ''.join(sorted(parser.chars.union('0123456789ABCDEF') - set('\t\n\r')))
+
+### precompression #############################################################
+
+# Text artifacts get .br and .gz siblings. deploy.py uploads the .gz one in
+# place of the original with Content-Encoding: gzip, the .br one is for
+# servers that pick a sibling by Accept-Encoding themselves. Both encoders
+# run at their maximum level, gzip without a timestamp so unchanged input
+# gives byte identical output and deploy can skip it. Images and woff2 are
+# already compressed and are left alone.
+precompress_suffixes = {'.html', '.json', '.svg', '.css', '.js', '.txt'}
+
+def precompress(dst_path:Path, jobs:int) -> None:
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        print("brotli not installed, only writing gzip variants")
+    encoders = [('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        encoders.append(('.br', lambda data: brotli.compress(data, quality=11)))
+    files = [p for p in dst_path.iterdir() if p.is_file() and p.suffix in precompress_suffixes]
+    def encode(job:tuple[Path,str,object]):
+        path, suffix, compress = job
+        with span('compress', file=path.name+suffix):
+            path.with_name(path.name+suffix).write_bytes(compress(path.read_bytes()))
+    # both encoders release the GIL while compressing
+    with ThreadPoolExecutor(jobs) as pool:
+        list(pool.map(encode, [(p,suffix,compress) for p in files for suffix,compress in encoders]))
+
+### watch mode #################################################################
+
+# Builds once, then serves dst_path and polls src_path and img_path. Parsed
+# metadata, artwork extents, rendered figures and the glyph set of the font
+# stay in memory, so an edit only reruns the stages it invalidates.
+def watch(port:int, skip_images:bool, pretty:bool, jobs:int, page_size:int|None, options:ThumbOptions,
+          src_path:Path, dst_path:Path, img_path:Path, data_path:Path, cache_path:Path):
+    # the artworks of the first build already carry their ladder
+    artworks = main(skip_images=skip_images, pretty=pretty, jobs=jobs, page_size=page_size, cascade=options.cascade,
+                    hashed=options.hashed, adaptive=options.adaptive, target_bpp=options.target_bpp,
+                    backend=options.backend, src_path=src_path, dst_path=dst_path, img_path=img_path,
+                    data_path=data_path, cache_path=cache_path)
+    serve(dst_path, port)
+    print(f"serving http://localhost:{port}/ and watching {src_path} and {img_path}, ^C to stop")
+
+    sources  = read_sources(src_path)
+    css      = css_variables(sources.style_css)
+    figures  = gen_figures(artworks, css, options)
+    text     = None
+    seen     = snapshot(src_path, img_path)
+    try:
+        while True:
+            sleep(0.25)
+            now = snapshot(src_path, img_path)
+            changed = set(p for p in seen.keys()|now.keys() if seen.get(p) != now.get(p))
+            if len(changed) == 0: continue
+            seen = now
+            start = perf_counter_ns()
+            stages = []
+            # the stages work on copies, a rebuild that fails half way must
+            # not leave the next one with a partial state
+            new_artworks, new_sources, new_css, new_figures = artworks, sources, css, figures
+            try:
+                if src_path/'metadata.yaml' in changed or any(p.is_relative_to(img_path) for p in changed):
+                    known = {a.meta.path:a for a in artworks}
+                    loaded, fresh = [], []
+                    for meta in parse_metadata(src_path/'metadata.yaml', img_path):
+                        art = known.get(meta.path)
+                        if art is None or art.meta != meta or meta.path in changed:
+                            art = load_image(meta, options.backend)
+                            fresh.append(art)
+                        loaded.append(art)
+                    stages.append(f'metadata ({len(fresh)} new)')
+                    # an original that fails never becomes known, so every
+                    # later rebuild verifies it again
+                    mismatches = verify_originals([a.meta for a in fresh], cache_path/"integrity.json", jobs)
+                    if len(mismatches) != 0:
+                        raise ValueError(f'{mismatches[0][0].path} does not match its sha3 in metadata.yaml')
+                    if not skip_images and len(fresh) > 0:
+                        generate_images(fresh, dst_path, ThumbCache(cache_path/"thumbs"), jobs, options)
+                        stages.append('images')
+                    else:
+                        load_cached(fresh, ThumbCache(cache_path/"thumbs"), options)
+                    new_artworks = loaded
+                    new_figures = None
+                if len(changed & {src_path/'style.css', src_path/'index.html', src_path/'icons.svg'}) > 0:
+                    new_sources = read_sources(src_path)
+                    new_css = css_variables(new_sources.style_css)
+                    if new_css != css:
+                        new_figures = None
+                    stages.append('sources')
+                if new_figures is None:
+                    new_figures = gen_figures(new_artworks, new_css, options)
+                    stages.append('figures')
+                page_figures, chunks = paginate(new_figures, page_size)
+                html = gen_page(new_sources, page_figures, pretty, chunks)
+                (dst_path/'index.html').write_text(html, encoding="utf-8")
+                write_chunks(dst_path, chunks)
+                stages.append('page')
+                new_text = visible_text(html + ''.join(map(''.join, chunks)))
+                if new_text != text:
+                    subset_font(data_path/"Nunito.ttf", dst_path/"nunito.woff2", new_text, cache_path/"fonts")
+                    stages.append('font')
+                precompress(dst_path, jobs)
+            except Exception as e:
+                # a half saved file should not end the session
+                print(f"rebuild failed: {type(e).__name__}: {e}")
+                continue
+            artworks, sources, css, figures, text = new_artworks, new_sources, new_css, new_figures, new_text
+            t = float(perf_counter_ns()-start)/1000000
+            print(f"rebuilt {', '.join(stages)} in {t:.1f}ms")
+    except KeyboardInterrupt:
+        print("\nstopped watching")
+
+def snapshot(*roots:Path) -> dict[Path,int]:
+    mtimes = {}
+    for root in roots:
+        for path in root.rglob('*'):
+            try:
+                if path.is_file(): mtimes[path] = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                pass
+    return mtimes
+
+def serve(path:Path, port:int) -> ThreadingHTTPServer:
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args): pass
+    server = ThreadingHTTPServer(('localhost', port), partial(QuietHandler, directory=str(path)))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 ### argument parsing ###########################################################
 from sys import argv
@@ -321,17 +1473,86 @@ f'''usage:
 flags:
   --help, -h     prints help message and quits
   --skip-images  skips all images to speed up build
-  --pretty       generates less compact but more debugable index.html'''
+  --pretty       generates less compact but more debugable index.html
+  --jobs N       number of processes encoding thumbnails, defaults to all cores
+  --no-cascade   resample every thumbnail from the original instead of from
+                 the next larger one, slower but useful to compare quality
+  --trace FILE   records build stages as a Chrome trace to FILE and prints
+                 a summary per stage
+  --watch        rebuilds whatever an edit in src/ or img/ affects and serves
+                 www/ on localhost
+  --port N       port of the --watch server, defaults to 8000
+  --page-size K  inlines only the first K gallery figures and loads the rest
+                 in chunks of K while scrolling
+  --hashed-names names thumbnails after a hash of their content, so they can
+                 be cached forever
+  --adaptive     encodes the full ladder but only keeps rungs at least 25%
+                 larger in bytes than the next smaller one
+  --target-bpp X encodes every rung at the highest quality that stays within
+                 X bytes per pixel
+  --backend NAME library that resizes and encodes thumbnails, wand (default)
+                 or pillow'''
+
+def pop_value(args:list[str], flag:str) -> str|None:
+    if flag not in args: return None
+    i = args.index(flag)
+    value = args[i+1] if i+1 < len(args) else ''
+    del args[i:i+2]
+    return value
 
 if __name__ == "__main__":
-    argset = set(argv[1:])
-    unrecognised_args = argset.difference({'-h','--help','--skip-images','--pretty'})
+    args = argv[1:]
+    jobs  = pop_value(args, '--jobs')
+    trace = pop_value(args, '--trace')
+    port  = pop_value(args, '--port')
+    page_size = pop_value(args, '--page-size')
+    target_bpp = pop_value(args, '--target-bpp')
+    backend    = pop_value(args, '--backend')
+    argset = set(args)
+    unrecognised_args = argset.difference({'-h','--help','--skip-images','--pretty','--no-cascade','--watch',
+                                           '--hashed-names','--adaptive'})
     if len( unrecognised_args ) != 0:
         s = 's' if len(unrecognised_args) > 1 else ''
         print(f"unrecognised argument{s}: {' '.join(unrecognised_args)}\n" + help_text(argv[0]))
+    elif jobs is not None and not (jobs.isdigit() and int(jobs) > 0):
+        print(f"--jobs expects a positive number, got '{jobs}'\n" + help_text(argv[0]))
+    elif port is not None and not (port.isdigit() and 0 < int(port) < 65536):
+        print(f"--port expects a port number, got '{port}'\n" + help_text(argv[0]))
+    elif page_size is not None and not (page_size.isdigit() and int(page_size) > 0):
+        print(f"--page-size expects a positive number, got '{page_size}'\n" + help_text(argv[0]))
+    elif target_bpp is not None and not (re.fullmatch(r'[0-9]*\.?[0-9]+', target_bpp) and float(target_bpp) > 0):
+        print(f"--target-bpp expects a positive number, got '{target_bpp}'\n" + help_text(argv[0]))
+    elif backend is not None and backend not in image_backends:
+        print(f"--backend expects one of {', '.join(image_backends)}, got '{backend}'\n" + help_text(argv[0]))
+    elif trace == '':
+        print("--trace expects a file name\n" + help_text(argv[0]))
     elif '-h' in argset or '--help' in argset:
         print(help_text(argv[0]))
+    elif '--watch' in argset:
+        watch(port        = 8000 if port is None else int(port),
+              skip_images = ('--skip-images' in argset),
+              pretty      = ('--pretty'      in argset),
+              jobs        = (os.cpu_count() or 1) if jobs is None else int(jobs),
+              page_size   = None if page_size is None else int(page_size),
+              options     = ThumbOptions(
+                  hashed     = ('--hashed-names' in argset),
+                  cascade    = ('--no-cascade'   not in argset),
+                  adaptive   = ('--adaptive'     in argset),
+                  target_bpp = None if target_bpp is None else float(target_bpp),
+                  backend    = 'wand' if backend is None else backend),
+              src_path    = Path(__file__).parent/"src",
+              dst_path    = Path(__file__).parent/"www",
+              img_path    = Path(__file__).parent/"img",
+              data_path   = Path(__file__).parent/"data",
+              cache_path  = Path(__file__).parent/"cache")
     else:
         main(skip_images = ('--skip-images' in argset),
-             pretty      = ('--pretty'      in argset))
-
+             pretty      = ('--pretty'      in argset),
+             cascade     = ('--no-cascade'  not in argset),
+             jobs        = (os.cpu_count() or 1) if jobs is None else int(jobs),
+             trace       = None if trace is None else Path(trace),
+             page_size   = None if page_size is None else int(page_size),
+             hashed      = ('--hashed-names' in argset),
+             adaptive    = ('--adaptive'     in argset),
+             target_bpp  = None if target_bpp is None else float(target_bpp),
+             backend     = 'wand' if backend is None else backend)
@@ -2,16 +2,98 @@
 from pathlib import Path
 from math import ceil
 from sys import exit
+from verify import verify_local
 
 local_path = Path(__file__).parent/"www"
+default_workers = 16
 
 ## main methods ################################################################
 
-def sync(skip_thumbs:bool=False):
-    s3 = authenticate()
+def sync(skip_thumbs:bool=False, workers:int=default_workers, dry_run:bool=False,
+         s3=None, www_path:Path=local_path):
+    missing = verify_local(www_path)
+    if len(missing) != 0:
+        exit(f'FATAL: index.html references {len(missing)} missing files, first {missing[0]}')
+
+    s3 = authenticate(workers) if s3 is None else s3
+    plan = plan_sync(s3, skip_thumbs, workers, www_path)
+    max_filename_len = max([len(s.key) for s in plan.steps] + [len(k) for k in plan.deletes], default=0)
+    if dry_run:
+        print_plan(plan, max_filename_len)
+    else:
+        execute_plan(s3, plan, workers, max_filename_len)
+    print_opcount()
+
+def push(local_files:list[str], workers:int=default_workers, s3=None, www_path:Path=local_path):
+    s3 = authenticate(workers) if s3 is None else s3
+    max_len = max([len(f) for f in local_files])
+    manifest = get_manifest(s3)
+    new_manifest = dict(manifest or {})
+    def push_file(file:str) -> Result:
+        return upload(s3, source_file(www_path/file), 'pushed unconditionally')
+    for file,result in zip(local_files, run_concurrently(push_file, local_files, workers)):
+        print_result(file, max_len, result)
+        key = object_key(source_file(www_path/file))
+        if result.entry is None:
+            new_manifest.pop(key, None)
+        else:
+            new_manifest[key] = result.entry
+    if manifest is not None:
+        update_manifest(s3, manifest, new_manifest, max_len)
+    print_opcount()
 
-    objects = list_objects(s3)
-    local_files = list(local_path.iterdir())
+### deploy plan ###############################################################
+from dataclasses import dataclass
+
+# A sync first works out what has to happen to every file and only then spends
+# any write requests on it. Planning reads the listing, the manifest and, for
+# files the manifest cannot vouch for, their headers. The plan can be printed
+# with --dry-run or handed to execute_plan. Uploads are ordered so that pages
+# go up last, once everything they reference is on the remote, and stale
+# objects are only deleted after the new pages are live.
+
+@dataclass(slots=True)
+class Step:
+    file   : Path
+    action : str               # 'upload' or 'skip'
+    reason : str
+    status : str = 'ok'
+    size   : int = 0
+    entry  : dict|None = None  # manifest entry of the file if it is in sync
+
+    @property
+    def key(self) -> str:
+        return object_key(self.file)
+
+@dataclass(slots=True)
+class Plan:
+    steps    : list[Step]      # in execution order
+    deletes  : list[str]
+    manifest : dict            # manifest on the remote, empty if there is none
+    carried  : dict            # entries of files this sync does not look at
+
+    @property
+    def uploads(self) -> list[Step]:
+        return [s for s in self.steps if s.action == 'upload']
+
+    @property
+    def upload_bytes(self) -> int:
+        return sum(s.size for s in self.uploads)
+
+    # uploads always change the etag of their entry
+    @property
+    def manifest_changes(self) -> bool:
+        kept = dict(self.carried, **{s.key:s.entry for s in self.steps if s.entry is not None})
+        return len(self.uploads) > 0 or kept != self.manifest
+
+def is_page(name:str) -> bool:
+    return mimetypes.guess_type(name)[0] == 'text/html'
+
+def plan_sync(s3, skip_thumbs:bool=False, workers:int=default_workers, www_path:Path=local_path) -> Plan:
+    remote_objects = list_objects(s3)
+    remote_objects.pop(manifest_key, None)
+    objects = remote_objects
+    local_files = deployed_files(www_path)
 
     if skip_thumbs:
         def is_thumb(s:str):
@@ -19,131 +101,408 @@ def sync(skip_thumbs:bool=False):
         objects     = {k:v for k,v in objects.items() if not is_thumb(k)}
         local_files = [f   for f   in local_files     if not is_thumb(f.name)]
 
-    local_file_names = [str(p.name) for p in local_files]
-    max_filename_len = max([len(p) for p in list(objects.keys())+local_file_names])
-
-    for file in local_files:
-        pending = lambda msg,act: print_pending(file.name, max_filename_len, msg, act)
-        if not file.is_file(): 
-            print_message(sym_warning, 'not a file', 'skipped')
-        elif file.name not in objects:
-            pending('not on remote','uploading')
-            put_object(s3, file)
-            print_done(sym_upload,'uploaded')
-        elif file.stat().st_size != objects[file.name]['Size']:
-            pending('different size on remote', 'uploading')
-            put_object(s3, file)
-            print_done(sym_upload,'uploaded')
+    manifest = get_manifest(s3)
+    if manifest is None:
+        print_message(sym_warning, 'no manifest on remote, checking hashes with headObject', 'fallback', status='warn')
+        manifest = {}
+
+    def plan_file(file:Path) -> Step:
+        key = object_key(file)
+        def upload(reason:str) -> Step:
+            return Step(file, 'upload', reason, size=file.stat().st_size)
+        if not file.is_file():
+            return Step(file, 'skip', 'not a file', 'warn')
+        elif key not in objects:
+            return upload('not on remote')
+        elif file.stat().st_size != objects[key]['Size']:
+            return upload('different size on remote')
+        elif is_immutable(key):
+            return Step(file, 'skip', 'immutable', entry=manifest.get(key))
+        remote = objects[key]
+        local  = manifest_entry(hash_file(file), remote['Size'], remote['ETag'], object_headers(file))
+        if manifest_matches(manifest.get(key), remote):
+            if local['sha3-256'] != manifest[key]['sha3-256']:
+                return upload('hash mismatch')
+            elif local['headers'] != manifest[key].get('headers'):
+                return upload('headers changed')
+            return Step(file, 'skip', 'hash matches', entry=local)
+        head = head_object(s3, file)
+        if head is None:
+            return Step(file, 'skip', 'failed to head', 'fail')
+        elif 'sha3-256' not in head['Metadata']:
+            return upload('missing sha3-256 hash')
+        elif local['sha3-256'] != head['Metadata']['sha3-256']:
+            return upload('hash mismatch')
+        elif local['headers'] != {k:head[k] for k in header_names if k in head}:
+            return upload('headers changed')
         else:
-            head = head_object(s3, file)
-            filename =pad_with_dots(file.name,max_filename_len)
-            if head is None:
-                print_message(sym_fail,'failed to head','skipped',status='fail',file=filename)
-            elif 'sha3-256' not in head['Metadata']:
-                pending('missing sha3-256 hash','uploading')
-                put_object(s3, file)
-                print_done(sym_upload,'uploaded')
-            elif hash(file.read_bytes()) != head['Metadata']['sha3-256']:
-                pending('hash mismatch','uploading')
-                put_object(s3, file)
-                print_done('sym_upload','done')
+            return Step(file, 'skip', 'hash matches', entry=local)
+
+    steps = list(run_concurrently(plan_file, local_files, workers))
+    # sorting is stable, skips keep their listing order ahead of the uploads
+    steps.sort(key=lambda s: (s.action == 'upload', is_page(s.key)))
+    local_file_names = set(object_key(f) for f in local_files)
+    return Plan(
+        steps    = steps,
+        deletes  = sorted(k for k in objects if k not in local_file_names),
+        manifest = manifest,
+        carried  = {k:v for k,v in manifest.items() if k in remote_objects and k not in objects})
+
+def execute_plan(s3, plan:Plan, workers:int, maxlen:int):
+    new_manifest = dict(plan.carried)
+    for step in plan.steps:
+        if step.action != 'upload':
+            print_result(step.key, maxlen, Result(step_symbol(step), 'skipped', step.reason, step.status))
+            if step.entry is not None:
+                new_manifest[step.key] = step.entry
+
+    def upload_step(step:Step) -> Result:
+        return upload(s3, step.file, step.reason)
+    uploads = plan.uploads
+    assets = [s for s in uploads if not is_page(s.key)]
+    pages  = [s for s in uploads if is_page(s.key)]
+    complete = True
+    for batch in (assets, pages):
+        if not complete:
+            # a page must not go live referencing a file that failed to upload
+            for step in batch:
+                print_result(step.key, maxlen, Result(sym_fail, 'skipped', 'earlier upload failed', 'fail'))
+            continue
+        for step,result in zip(batch, run_concurrently(upload_step, batch, workers)):
+            print_result(step.key, maxlen, result)
+            if result.entry is None:
+                complete = False
             else:
-                print_message(sym_skip,'hash matches','skipped',file=filename)
+                new_manifest[step.key] = result.entry
 
-    extra_remote_files = list(set(objects.keys()) - set(local_file_names))
-    if len(extra_remote_files) == 0:
+    if len(plan.deletes) == 0:
         print_message(sym_clean, 'remote is clean', 'skipped')
     else:
-        st = []
-        pending('remote not clean','deleting')
-        if delete_objects(s3, extra_remote_files):
-            print_done(sym_delete,'deleted')
+        n = len(plan.deletes)
+        if not complete:
+            # the old pages are still live and may reference these
+            print_message(sym_fail, 'upload failed, remote not cleaned', 'skipped', f'{n} file{"s" if n>1 else ""} ', status='fail')
+        else:
+            print_pending(f'{n} file{"s" if n>1 else ""}', maxlen, 'remote not clean', 'deleting')
+            if delete_objects(s3, plan.deletes, workers):
+                print_done(sym_delete,'deleted')
+            else:
+                print_done(sym_fail,'skipped',status='fail')
+
+    update_manifest(s3, plan.manifest, new_manifest, maxlen)
+
+# The requests execute_plan would make, in the layout of opcount. A failed
+# upload or delete may still cost less, retries by botocore may cost more.
+def projected_opcount(plan:Plan) -> dict[str,list[int]]:
+    counts = {}
+    def add(op:str, opclass:str, n:int=1):
+        counts.setdefault(op, [0,0,0])[opclass_index[opclass]] += n
+    for step in plan.uploads:
+        if step.size > multipart_threshold:
+            add('createMultipartUpload', 'A')
+            add('uploadPart', 'A', ceil(step.size/multipart_chunk))
+            add('completeMultipartUpload', 'A')
         else:
-            print_done(sym_fail,'skipped',status='fail')
+            add('putObject', 'A')
+    if len(plan.deletes) > 0:
+        add('deleteObjects', '0', ceil(len(plan.deletes)/delete_batch))
+    if plan.manifest_changes:
+        add('putObject', 'A')
+    return counts
+
+### manifest ###################################################################
+import json
+
+# A single object on the bucket records the sha3-256 and size of every file,
+# so a sync needs one getObject instead of a headObject per file. Each entry
+# also stores the ETag the object had when it was written; if the listing
+# disagrees the object was changed behind the manifest's back and that file
+# falls back to headObject. The manifest is replaced with one putObject at
+# the end of a sync, which S3 applies atomically. The headers an object was
+# written with are recorded too, so changing them uploads the file again.
+manifest_key = '.manifest.json'
+
+def manifest_entry(sha3:str, size:int, etag:str, headers:dict[str,str]) -> dict:
+    return {'sha3-256': sha3, 'size': size, 'etag': etag, 'headers': headers}
+
+def manifest_matches(entry:dict|None, remote:dict) -> bool:
+    return entry is not None \
+       and entry.get('size') == remote['Size'] \
+       and entry.get('etag') == remote['ETag'] \
+       and 'sha3-256' in entry
+
+def get_manifest(s3) -> dict|None:
+    inc_opcount('getObject','B')
+    try:
+        response = s3.get_object(Bucket='www', Key=manifest_key)
+        manifest = json.loads(response['Body'].read())
+    except Exception as e:
+        return None
+    return manifest if isinstance(manifest, dict) else None
 
-    print_opcount()
+def update_manifest(s3, old:dict, new:dict, maxlen:int):
+    if old == new: return
+    print_pending(manifest_key, maxlen, 'manifest changed', 'uploading')
+    inc_opcount('putObject','A')
+    try:
+        s3.put_object(
+            Key=manifest_key,
+            Body=json.dumps(new, sort_keys=True, indent=0).encode('utf-8'),
+            Bucket='www',
+            ContentType='application/json')
+    except Exception as e:
+        print_done(sym_fail,'failed',status='fail')
+        return
+    print_done(sym_upload,'uploaded')
+
+### object headers #############################################################
+import mimetypes
+import re
+
+# build.py writes .br and .gz variants next to text artifacts. A bucket never
+# picks a sibling key by Accept-Encoding, so the .gz variant is uploaded in
+# place of the original, under its key, with Content-Encoding: gzip, which
+# every browser accepts. A variant older than its original was not written
+# from the current bytes, then the original is uploaded as is. The .br
+# variants are for servers that negotiate siblings themselves and are not
+# uploaded. Pages and chunks change with every build and must be
+# revalidated, everything else may be cached for a day. Thumbnails built
+# with --hashed-names never change under their name, they are cached forever
+# and an existing key is never checked again.
+revalidated_types = {'text/html', 'application/json'}
+header_names = ['ContentType', 'CacheControl', 'ContentEncoding']
+immutable_name = re.compile(r'-[0-9]+w\.[0-9a-f]{16}\.[a-z0-9]+$')
+
+def is_immutable(name:str) -> bool:
+    return immutable_name.search(name) is not None
+
+def is_variant(path:Path) -> bool:
+    return path.suffix in ('.gz', '.br') and path.with_name(path.stem).is_file()
+
+# the file uploaded for path, its gzip variant if build.py wrote one from
+# the current bytes of path
+def source_file(path:Path) -> Path:
+    variant = path.with_name(path.name + '.gz')
+    if path.is_file() and variant.is_file() and variant.stat().st_mtime_ns >= path.stat().st_mtime_ns:
+        return variant
+    return path
+
+# the key a source file is uploaded under
+def object_key(path:Path) -> str:
+    return path.stem if path.suffix == '.gz' and is_variant(path) else path.name
+
+def deployed_files(www_path:Path) -> list[Path]:
+    return [source_file(p) for p in www_path.iterdir() if not is_variant(p)]
+
+def object_headers(path:Path) -> dict[str,str]:
+    content_type, encoding = mimetypes.guess_type(path.name)
+    if content_type is None:
+        content_type = sniff_type(path)
+    headers = {
+        'ContentType':  content_type + ('; charset=utf-8' if content_type.startswith('text/') else ''),
+        'CacheControl': 'no-cache' if content_type in revalidated_types else \
+                        'public, max-age=31536000, immutable' if is_immutable(object_key(path)) else \
+                        'public, max-age=86400' }
+    if encoding is not None:
+        headers['ContentEncoding'] = encoding
+    return headers
+
+# originals are copied without their extension
+def sniff_type(path:Path) -> str:
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    if head.startswith(b'\x89PNG\r\n\x1a\n'): return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):        return 'image/jpeg'
+    if head[4:12] in (b'ftypavif', b'ftypavis'): return 'image/avif'
+    if head[0:4] == b'RIFF' and head[8:12] == b'WEBP': return 'image/webp'
+    return 'application/octet-stream'
+
+### concurrency ################################################################
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# Requests are latency bound, so files are handled by a pool of threads that
+# share one client and its connection pool. Results are yielded in input
+# order, which keeps the status output stable no matter which request
+# finishes first.
+
+@dataclass(slots=True)
+class Result:
+    symbol       : str
+    action_taken : str
+    msg          : str
+    status       : str = 'ok'
+    entry        : dict|None = None  # manifest entry of the file if it is in sync
+
+def run_concurrently(fn, items:list, workers:int):
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        yield from pool.map(fn, items)
+    finally:
+        # on ^C do not wait for requests that have not been started yet
+        pool.shutdown(cancel_futures=True)
 
-def push(local_files:list[str]):
-    s3 = authenticate()
-    max_len = max([len(f) for f in local_files])
-    for file in local_files:
-        print_pending(file, max_len, 'pushed unconditionally','uploading')
-        put_object(s3, local_path/file)
-        print_done(sym_upload,'uploaded')
-    print_opcount()
+def upload(s3, file:Path, reason:str) -> Result:
+    try:
+        entry = put_object(s3, file)
+    except Exception as e:
+        return Result(sym_fail, 'failed', f'{reason}, {type(e).__name__}', 'fail')
+    return Result(sym_upload, 'uploaded', reason, entry=entry)
 
 ### s3 helpers #################################################################
 import boto3
-from hashlib import sha3_256
+from botocore.config import Config
+from hashlib import sha3_256, file_digest
 from base64  import urlsafe_b64encode
-
-def hash(file_bytes:bytes):
-    return urlsafe_b64encode(sha3_256(file_bytes).digest()).decode('ascii')
-
-def authenticate():
+from typing  import Iterator
+from os      import environ
+
+# Files are hashed in chunks straight from disk and at most once per run,
+# no matter how many times sync and put_object ask for the hash.
+hashes:dict[Path,str] = {}
+
+def hash_file(path:Path) -> str:
+    if path not in hashes:
+        with open(path, 'rb') as f:
+            digest = file_digest(f, sha3_256).digest()
+        hashes[path] = urlsafe_b64encode(digest).decode('ascii')
+    return hashes[path]
+
+# The endpoint and credentials default to the R2 bucket described by .secrets.
+# Arguments or the S3_* environment variables take precedence, which points
+# a deploy at any S3 compatible server, e.g. a local one for testing.
+def authenticate(workers:int=default_workers,
+                 endpoint_url:str|None=None, access_key_id:str|None=None, access_key:str|None=None):
     secrets_path =  Path(__file__).parent/".secrets"
+    def secret(name:str) -> str:
+        return (secrets_path/name).read_text(encoding='utf-8').strip()
+    # botocore retries throttling and transient errors with exponential backoff
+    config = Config(
+        max_pool_connections = workers,
+        retries = {'max_attempts': 5, 'mode': 'standard'})
     return boto3.client('s3',
-        aws_access_key_id = (secrets_path/'access_key_id').read_text(encoding='utf-8').strip(),
-        aws_secret_access_key = (secrets_path/'access_key').read_text(encoding='utf-8').strip(),
-        endpoint_url = f"https://{(secrets_path/'account_id').read_text(encoding='utf-8').strip()}.r2.cloudflarestorage.com",
-        region_name = 'auto')
+        config = config,
+        aws_access_key_id     = access_key_id or environ.get('S3_ACCESS_KEY_ID') or secret('access_key_id'),
+        aws_secret_access_key = access_key    or environ.get('S3_ACCESS_KEY')    or secret('access_key'),
+        endpoint_url = endpoint_url or environ.get('S3_ENDPOINT_URL') or \
+                       f"https://{secret('account_id')}.r2.cloudflarestorage.com",
+        region_name  = environ.get('S3_REGION', 'auto'))
 
 def head_object(s3, file:Path) -> dict|None:
     inc_opcount('headObject','B')
     try:
-        ret = s3.head_object(Bucket='www', Key=file.name)
+        ret = s3.head_object(Bucket='www', Key=object_key(file))
     except Exception as e:
         return None
     return ret
 
-def delete_objects(s3, names:list[str]) -> bool:
-    if len(names) == 0: return True
+# deleteObjects accepts at most 1000 keys per request
+delete_batch = 1000
+
+def delete_objects(s3, names:list[str], workers:int=default_workers) -> bool:
+    batches = [names[i:i+delete_batch] for i in range(0, len(names), delete_batch)]
+    return all(run_concurrently(lambda batch: delete_batch_objects(s3, batch), batches, workers))
+
+def delete_batch_objects(s3, names:list[str]) -> bool:
     inc_opcount('deleteObjects','0')
     try:
-        s3.delete_objects(
+        response = s3.delete_objects(
             Bucket='www',
             Delete={
                 'Objects': [{'Key':n} for n in names],
                 'Quiet': True })
     except Exception as e:
         return False
-    return True
+    return len(response.get('Errors', [])) == 0
+
+def iter_objects(s3) -> Iterator[tuple[str,dict]]:
+    # listObjectsV2 returns at most 1000 keys, follow the continuation tokens
+    args = {'Bucket': 'www'}
+    while True:
+        inc_opcount('listObjectsV2','A')
+        try:
+            response = s3.list_objects_v2(**args)
+        except Exception as e:
+            exit('FATAL: listObjectsV2 failed')
+        for o in response.get('Contents', []):
+            key = o.pop('Key')
+            yield key, o
+        if not response['IsTruncated']:
+            return
+        args['ContinuationToken'] = response['NextContinuationToken']
 
 def list_objects(s3) -> dict:
-    inc_opcount('listObjectsV2','A')
-    try:
-        response = s3.list_objects_v2(Bucket='www')
-    except Exception as e:
-        exit('FATAL: listObjectsV2 failed')
-
-    if response['IsTruncated']:
-        exit('FATAL: listObjectsV2 truncated response not yet supported')
-
-    files = {}
-    for o in response['Contents']:
-        key = o['Key']
-        o.pop('Key')
-        files[key] = o
-    return files
-
-def put_object(s3, filepath:Path):
-    file_bytes = filepath.read_bytes()
-    inc_opcount('putObject','A')
-    s3.put_object(
-        Key=filepath.name,
-        Body=file_bytes,
+    return dict(iter_objects(s3))
+
+# Files above the threshold are uploaded in parts, so no more than one part
+# per worker is ever held in memory. R2 requires parts of at least 5 MiB.
+multipart_threshold = 16*1024*1024
+multipart_chunk     =  8*1024*1024
+
+def put_object(s3, filepath:Path) -> dict:
+    file_hash = hash_file(filepath)
+    headers = object_headers(filepath)
+    size = filepath.stat().st_size
+    if size > multipart_threshold:
+        etag = put_object_multipart(s3, filepath, file_hash, headers)
+    else:
+        inc_opcount('putObject','A')
+        with open(filepath, 'rb') as f:
+            etag = s3.put_object(
+                Key=object_key(filepath),
+                Body=f,
+                Bucket='www',
+                Metadata={
+                    'sha3-256': file_hash
+                },
+                **headers)['ETag']
+    return manifest_entry(file_hash, size, etag, headers)
+
+def put_object_multipart(s3, filepath:Path, file_hash:str, headers:dict[str,str]) -> str:
+    inc_opcount('createMultipartUpload','A')
+    upload_id = s3.create_multipart_upload(
+        Key=object_key(filepath),
         Bucket='www',
         Metadata={
-            'sha3-256': hash(file_bytes)
-        })
+            'sha3-256': file_hash
+        },
+        **headers)['UploadId']
+    try:
+        parts = []
+        with open(filepath, 'rb') as f:
+            while chunk := f.read(multipart_chunk):
+                inc_opcount('uploadPart','A')
+                response = s3.upload_part(
+                    Key=object_key(filepath),
+                    Bucket='www',
+                    UploadId=upload_id,
+                    PartNumber=len(parts)+1,
+                    Body=chunk)
+                parts.append({'PartNumber': len(parts)+1, 'ETag': response['ETag']})
+        inc_opcount('completeMultipartUpload','A')
+        return s3.complete_multipart_upload(
+            Key=object_key(filepath),
+            Bucket='www',
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts})['ETag']
+    except BaseException:
+        inc_opcount('abortMultipartUpload','0')
+        try:
+            s3.abort_multipart_upload(Key=object_key(filepath), Bucket='www', UploadId=upload_id)
+        except Exception as e:
+            pass
+        raise
 
 opcount = { }
+opcount_lock = Lock()
+opclass_index = {'A':0,'B':1,'0':2}
 
 def inc_opcount(op:str, opclass:str):
-    idx = {'A':0,'B':1,'0':2}[opclass];
-    if op not in opcount:
-        opcount[op] = [0,0,0]
-    opcount[op][idx] += 1
+    idx = opclass_index[opclass]
+    with opcount_lock:
+        if op not in opcount:
+            opcount[op] = [0,0,0]
+        opcount[op][idx] += 1
 
 ### pretty printing ############################################################
 
@@ -203,12 +562,16 @@ def print_done(symbol:str, action_taken:str, status:str='ok'):
 def print_message(symbol:str, msg:str, action_taken:str, file:str='', status:str='ok'):
     print(symbol + column(3) + style(status, action_taken.ljust(maxlen_action+1)) + file + italic(msg))
 
-def print_opcount():
-    max_op_len = max([len(key) for key in opcount])
+def print_result(name:str, maxlen:int, result:Result):
+    print_message(result.symbol, result.msg, result.action_taken,
+                  file=pad_with_dots(name,maxlen), status=result.status)
+
+def print_opcount(counts:dict[str,list[int]]=opcount, label:str='op'):
+    max_op_len = max([len(key) for key in counts] + [len(label), len('total')])
     lines = []
-    lines.append('op'.ljust(max_op_len) + '    A    B    0')
+    lines.append(label.ljust(max_op_len) + '    A    B    0')
     total = [0,0,0]
-    for k,v in opcount.items():
+    for k,v in counts.items():
         line = k.ljust(max_op_len)
         for i,n in enumerate(v):
             line += '    ·' if n==0 else f'{n:>5}'
@@ -220,24 +583,55 @@ def print_opcount():
     lines.append(line);
     print('\n'.join(boxify(lines)))
 
+def step_symbol(step:Step) -> str:
+    return {'warn':sym_warning, 'fail':sym_fail}.get(step.status, sym_upload if step.action == 'upload' else sym_skip)
+
+def format_bytes(n:int) -> str:
+    for unit in ['B', 'KiB', 'MiB']:
+        if n < 1024: return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} GiB'
+
+def print_plan(plan:Plan, maxlen:int):
+    for step in plan.steps:
+        print_message(step_symbol(step), step.reason, step.action,
+                      file=pad_with_dots(step.key, maxlen), status=step.status)
+    for name in plan.deletes:
+        print_message(sym_delete, 'not in local', 'delete', file=pad_with_dots(name, maxlen))
+    if plan.manifest_changes:
+        print_message(sym_upload, 'manifest changed', 'upload', file=pad_with_dots(manifest_key, maxlen))
+    n = len(plan.uploads)
+    print_message(sym_clean, f'{n} file{"s" if n!=1 else ""}, {format_bytes(plan.upload_bytes)} to transfer', 'dry run')
+    print_opcount(projected_opcount(plan), 'projected')
+
 ### argument parsing ###########################################################
 
 if __name__ == "__main__":
     from sys import argv
+    args = argv[1:]
     try:
-        if '-h' in set(argv[1:]) or '--help' in set(argv[1:]):
-            print(f"{style('warn',argv[0])} {italic('[--skip-thumbs]')}")
+        workers = default_workers
+        if '--workers' in args:
+            i = args.index('--workers')
+            workers = int(args[i+1]) if i+1 < len(args) and args[i+1].isdigit() else 0
+            del args[i:i+2]
+            if workers < 1: exit('--workers expects a positive number')
+        if '-h' in set(args) or '--help' in set(args):
+            print(f"{style('warn',argv[0])} {italic('[--skip-thumbs] [--dry-run] [--workers N]')}")
             print(f"    Syncs the remote to be identical to local.")
             print(f"    {bold('--skip-thumbs')}  Skip thumbnails.")
-            print(f"{style('warn',argv[0]+' push')} {italic('[files...]')}")
+            print(f"    {bold('--dry-run')}      Print the plan and the requests it would make, change nothing.")
+            print(f"    {bold('--workers N')}    Number of concurrent requests, defaults to {default_workers}.")
+            print(f"{style('warn',argv[0]+' push')} {italic('[--workers N] [files...]')}")
             print(f"    Pushes local files to remote unconditionally.")
-        elif len(argv)>2 and argv[1] == 'push':
-            push(argv[2:])
+            print(f"The bucket defaults to R2 with the credentials in .secrets. S3_ENDPOINT_URL,")
+            print(f"S3_ACCESS_KEY_ID, S3_ACCESS_KEY and S3_REGION override it.")
+        elif len(args)>1 and args[0] == 'push':
+            push(args[1:], workers)
         else:
-            argset = set(argv[1:])
-            sync(skip_thumbs=('--skip-thumbs' in argset))
+            argset = set(args)
+            sync(skip_thumbs=('--skip-thumbs' in argset), workers=workers, dry_run=('--dry-run' in argset))
     except KeyboardInterrupt:
         print('\ninterrupted')
         print_opcount()
         exit()
-
@@ -1,75 +1,188 @@
 #!/usr/bin/env python3
-from sys import exit
-import requests
-from bs4 import BeautifulSoup
-
-def main():
-    index_html = requests.get('https://snipsel.net')
-    if index_html.status_code != 200: exit("index_html not 200")
-    soup = BeautifulSoup(index_html.text, 'html.parser')
-
-    thumbs = get_thumbs(soup)
-    print(f"checking {len(thumbs)} thumbnails")
-    failed_thumbs = []
-    for thumb in thumbs:
-        if requests.head(f'https://snipsel.net/{thumb}').status_code != 200:
-            failed_thumbs.append(thumb)
+from sys import exit, argv
+import asyncio
+import json
+from pathlib import Path
+from time import perf_counter
+from urllib.parse import urlsplit
+from verify import PageReferences, verify_local, default_www_path
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    # only needed for checking a live site, --offline works without it
+    import aiohttp
 
+default_base_url = 'https://snipsel.net'
+
+def main(base_url    = default_base_url,
+         concurrency = 32,
+         per_host    = 4,
+         timeout     = 10.0,
+         report      = None):
+    results = asyncio.run(check_site(base_url, concurrency, per_host, timeout))
+    if results is None: exit("index_html not 200")
+    thumbs, internal, external = results
+
+    print(f"checked {len(thumbs)} thumbnails")
+    failed_thumbs = [r for r in thumbs if r['status'] != 200]
     if len(failed_thumbs)==0:
         print("thumbnails OK")
     else:
         print("failed thumbs:")
-        for thumb in failed_thumbs:
-            print(thumb)
-
-    internal, external = get_links(soup)
-
-    print(f'testing {len(internal)} internal links')
-    failed_internal_links = []
-    for link in internal:
-        link = f'https://snipsel.net/{link}'
-        req = requests.head(link)
-        print(f'{req.status_code} {link}')
-        if req.status_code != 200:
-            failed_internal_links.append(link)
+        for r in failed_thumbs:
+            print(r['url'])
+
+    print(f'tested {len(internal)} internal links')
+    for r in internal:
+        print(f"{r['status'] or r['error']} {r['url']}")
+    failed_internal_links = [r for r in internal if r['status'] != 200]
     if len(failed_internal_links)==0:
         print("internal links OK")
     else:
         print("failed internal links:")
-        for link in failed_internal_links:
-            print(link)
-
-    print(f'testing {len(external)} external links')
-    failed_external_links = []
-    for link in external:
-        req = requests.head(link)
-        print(f'{req.status_code} {link}')
-        if requests.head(link).status_code == 404:
-            failed_external_links.append(link)
+        for r in failed_internal_links:
+            print(r['url'])
+
+    print(f'tested {len(external)} external links')
+    for r in external:
+        print(f"{r['status'] or r['error']} {r['url']}")
+    # plenty of sites refuse HEAD requests, only a 404 is a sure sign
+    failed_external_links = [r for r in external if r['status'] == 404]
     if len(failed_external_links)==0:
         print("external links probably OK")
     else:
         print("failed external links:")
-        for link in failed_external_links:
-            print(link)
-
-def get_thumbs(soup):
-    thumbs = []
-    for source in soup.find_all('source'):
-        for imgsrc in source['srcset'].split(','):
-            thumbs.append(imgsrc.split(' ')[0])
-    return list(set(thumbs))
-
-def get_links(soup):
-    external = []
-    internal = []
-    for anchor in soup.find_all('a'):
-        href = anchor['href']
-        if href.startswith('https://'):
-            external.append(href)
-        else:
-            internal.append(href)
-    return list(set(internal)),list(set(external))
+        for r in failed_external_links:
+            print(r['url'])
+
+    if report is not None:
+        with open(report, 'w', encoding='utf-8') as f:
+            json.dump({
+                'base_url': base_url,
+                'thumbs':   thumbs,
+                'internal': internal,
+                'external': external,
+                'failed': {
+                    'thumbs':   [r['url'] for r in failed_thumbs],
+                    'internal': [r['url'] for r in failed_internal_links],
+                    'external': [r['url'] for r in failed_external_links] }
+                }, f, indent=2)
+
+### checking ###################################################################
+
+# All requests share one connection pool. At most `concurrency` requests are
+# in flight, and at most `per_host` to any one host, so a gallery full of
+# links to the same few sites does not hammer any one of them. Requests wait
+# for a slot on semaphores before they are sent, so the timeout and the
+# reported seconds cover the request alone and not the time spent queueing.
+async def check_site(base_url:str, concurrency:int, per_host:int, timeout:float):
+    import aiohttp
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    # trust_env picks up proxy settings from the environment, like requests did
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout, trust_env=True) as session:
+        async with session.get(base_url) as index_html:
+            if index_html.status != 200: return None
+            refs = PageReferences()
+            refs.feed(await index_html.text())
+        # figures of a paginated gallery live in json chunks
+        for chunk in list(refs.chunks):
+            async with session.get(f'{base_url}/{chunk}') as response:
+                if response.status == 200:
+                    refs.add_figures(await response.json(content_type=None))
+        refs.close()
+
+        external = refs.external
+        thumbs = [f'{base_url}/{thumb}' for thumb in refs.thumbs]
+        internal = [f'{base_url}/{link}' for link in refs.internal]
+        slots = asyncio.Semaphore(concurrency)
+        host_slots:dict[str,asyncio.Semaphore] = {}
+        async def head_in_slot(url:str) -> dict:
+            host_slot = host_slots.setdefault(urlsplit(url).hostname or '', asyncio.Semaphore(per_host))
+            # a busy host must not hold on to one of the global slots
+            async with host_slot, slots:
+                return await head(session, url, timeout)
+        results = await asyncio.gather(*[head_in_slot(url) for url in thumbs+internal+external])
+    n,m = len(thumbs), len(thumbs)+len(internal)
+    return results[:n], results[n:m], results[m:]
+
+async def head(session:'aiohttp.ClientSession', url:str, timeout:float) -> dict:
+    import aiohttp
+    start = perf_counter()
+    try:
+        async with session.head(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            status, error = response.status, None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status, error = None, f'{type(e).__name__}: {e}'
+    return {
+        'url':     url,
+        'host':    urlsplit(url).hostname,
+        'status':  status,
+        'error':   error,
+        'seconds': round(perf_counter()-start, 3) }
+
+### offline verification #####################################################
+
+def main_offline(www_path:Path):
+    start = perf_counter()
+    missing = verify_local(www_path)
+    if len(missing) == 0:
+        print(f"all references present ({perf_counter()-start:.3f}s)")
+    else:
+        print("missing files:")
+        for ref in missing:
+            print(ref)
+        exit(1)
+
+### argument parsing ###########################################################
+
+def help_text(exe:str) -> str:
+    return \
+f'''usage:
+  {exe} [flags..]
+flags:
+  --help, -h         prints help message and quits
+  --base-url URL     site to check, defaults to {default_base_url}
+  --concurrency N    maximum number of open connections, defaults to 32
+  --per-host N       maximum number of open connections per host, defaults to 4
+  --timeout SECONDS  timeout of a single request, defaults to 10
+  --report FILE      writes every result as JSON to FILE
+  --offline [DIR]    only checks that every file referenced by the built
+                     index.html exists in DIR, defaults to www/'''
+
+def pop_value(args:list[str], flag:str) -> str|None:
+    if flag not in args: return None
+    i = args.index(flag)
+    value = args[i+1] if i+1 < len(args) else ''
+    del args[i:i+2]
+    return value
 
 if __name__ == '__main__':
-    main()
+    args = argv[1:]
+    base_url    = pop_value(args, '--base-url')
+    concurrency = pop_value(args, '--concurrency')
+    per_host    = pop_value(args, '--per-host')
+    timeout     = pop_value(args, '--timeout')
+    report      = pop_value(args, '--report')
+    offline     = '--offline' in args
+    if offline:
+        www_path = pop_value(args, '--offline')
+        if www_path is not None and www_path.startswith('-'):
+            args.append(www_path)
+            www_path = ''
+    if '-h' in args or '--help' in args:
+        print(help_text(argv[0]))
+    elif len(args) != 0:
+        s = 's' if len(args) > 1 else ''
+        print(f"unrecognised argument{s}: {' '.join(args)}\n" + help_text(argv[0]))
+    elif any(v is not None and not (v.isdigit() and int(v) > 0) for v in (concurrency, per_host)):
+        print("--concurrency and --per-host expect a positive number\n" + help_text(argv[0]))
+    elif timeout is not None and not (timeout.replace('.', '', 1).isdigit() and float(timeout) > 0):
+        print("--timeout expects a positive number of seconds\n" + help_text(argv[0]))
+    elif offline:
+        main_offline(Path(www_path) if www_path else default_www_path)
+    else:
+        main(base_url    = default_base_url if base_url is None else base_url.rstrip('/'),
+             concurrency = 32   if concurrency is None else int(concurrency),
+             per_host    = 4    if per_host    is None else int(per_host),
+             timeout     = 10.0 if timeout     is None else float(timeout),
+             report      = report)
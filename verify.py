@@ -0,0 +1,70 @@
+import json
+from html.parser import HTMLParser
+from pathlib import Path
+from urllib.parse import urlsplit, unquote
+
+default_www_path = Path(__file__).parent/"www"
+
+### references #################################################################
+
+# Collects everything a built page points at. Only the standard library is
+# used, so deploy.py can verify a build without the dependencies of the live
+# check in test.py. Figures of a paginated gallery live in json chunks and
+# are fed separately with add_figures().
+class PageReferences(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.thumbs:set[str] = set()
+        self.links :set[str] = set()
+        self.assets:set[str] = set()
+        self.chunks:list[str] = []
+
+    def handle_starttag(self, tag:str, attrs:list[tuple[str,str|None]]):
+        attrs = {k:v for k,v in attrs if v is not None}
+        if tag == 'source' and 'srcset' in attrs:
+            for imgsrc in attrs['srcset'].split(','):
+                self.thumbs.add(imgsrc.strip().split(' ')[0])
+        elif tag == 'a' and 'href' in attrs:
+            self.links.add(attrs['href'])
+        elif tag == 'img' and 'src' in attrs:
+            self.assets.add(attrs['src'])
+        elif tag == 'link' and 'href' in attrs:
+            self.assets.add(attrs['href'])
+        if 'data-chunks' in attrs:
+            self.chunks += attrs['data-chunks'].split(',')
+
+    def add_figures(self, figures:list[str]):
+        for figure in figures:
+            self.feed(figure)
+
+    @property
+    def internal(self) -> list[str]:
+        return [l for l in self.links if is_local(l)]
+
+    @property
+    def external(self) -> list[str]:
+        return [l for l in self.links if urlsplit(l).scheme in ('http', 'https')]
+
+# mailto: and other schemes are neither, there is nothing to request
+def is_local(ref:str) -> bool:
+    parts = urlsplit(ref)
+    return parts.scheme == '' and parts.netloc == ''
+
+### offline verification #######################################################
+
+# Checks every file referenced by the generated index.html against the build
+# output on disk, without any network access. Returns the missing references.
+def verify_local(www_path:Path=default_www_path) -> list[str]:
+    refs = PageReferences()
+    refs.feed((www_path/'index.html').read_text(encoding='utf-8'))
+    present = set(p.name for p in www_path.iterdir() if p.is_file())
+    for chunk in list(refs.chunks):
+        if chunk in present:
+            refs.add_figures(json.loads((www_path/chunk).read_text(encoding='utf-8')))
+    refs.close()
+    missing = []
+    for ref in sorted(refs.thumbs | set(refs.internal) | refs.assets | set(refs.chunks)):
+        name = unquote(urlsplit(ref).path)
+        if is_local(ref) and name != '' and name not in present:
+            missing.append(ref)
+    return missing